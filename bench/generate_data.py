@@ -0,0 +1,118 @@
+import argparse
+import csv
+import random
+
+# columns of the EPA "Detailed Data by Manufacturer" export (Table A-1)
+COLUMNS = ['Manufacturer', 'Model Year', 'Regulatory Class', 'Vehicle Type', 'Production Share',
+           'Real-World MPG', 'Real-World MPG_City', 'Real-World MPG_Hwy',
+           'Real-World CO2 (g/mi)', 'Real-World CO2_City (g/mi)', 'Real-World CO2_Hwy (g/mi)',
+           'Weight (lbs)', 'Footprint (sq. ft.)', 'Engine Displacement', 'Horsepower (HP)',
+           'Acceleration (0-60 time in seconds)', 'HP/Engine Displacement', 'HP/Weight (lbs)',
+           '2-Cycle MPG', 'Powertrain - Diesel', 'Powertrain - Electric Vehicle (EV)',
+           'Powertrain - Plug-in Hybrid (PHEV)', 'Powertrain - Fuel Cell Vehicle (FCV)',
+           'Powertrain - Other (incl. CNG)', 'Powertrain - Gasoline Hybrid', 'Powertrain - Gasoline',
+           'Drivetrain - Front', 'Drivetrain - 4WD', 'Drivetrain - Rear',
+           'Fuel Delivery - Carbureted', 'Fuel Delivery - Gasoline Direct Injection (GDI)',
+           'Fuel Delivery - Port Fuel Injection', 'Fuel Delivery - Throttle Body Injection',
+           'Fuel Delivery - Other', 'Transmission - Manual', 'Transmission - Automatic',
+           'Transmission - Continuously Variable (Non-Hybrid)', 'Transmission - CVT (Hybrid)',
+           'Transmission - Other', '4 or Fewer Gears', '5 Gears', '6 Gears', '7 Gears', '8 Gears',
+           '9 or More Gears', 'Average Number of Gears', 'Multivalve Engine', 'Turbocharged Engine',
+           'Stop/Start', 'Cylinder Deactivation']
+
+# manufacturers of the real table and the first model year each one reports
+MANUFACTURERS = {'All': 1975, 'BMW': 1975, 'Ford': 1975, 'GM': 1975, 'Honda': 1975, 'Hyundai': 1986,
+                 'Kia': 1994, 'Mazda': 1975, 'Mercedes': 1975, 'Nissan': 1975, 'Stellantis': 1975,
+                 'Subaru': 1975, 'Tesla': 2012, 'Toyota': 1975, 'VW': 1975}
+VEHICLE_TYPES = ['All', 'All Car', 'All Truck', 'Sedan/Wagon', 'Car SUV', 'Truck SUV', 'Minivan/Van', 'Pickup']
+YEARS = [str(year) for year in range(1975, 2022)] + ['Prelim. 2022']
+
+# columns that only hold shares of production, and the first year each is reported,
+# before which the real table has '-'
+SHARE_COLUMNS = {'Powertrain - Diesel': 1975, 'Powertrain - Electric Vehicle (EV)': 2011,
+                 'Powertrain - Plug-in Hybrid (PHEV)': 2011, 'Powertrain - Fuel Cell Vehicle (FCV)': 2016,
+                 'Powertrain - Other (incl. CNG)': 1975, 'Powertrain - Gasoline Hybrid': 2000,
+                 'Powertrain - Gasoline': 1975, 'Drivetrain - Front': 1975, 'Drivetrain - 4WD': 1975,
+                 'Drivetrain - Rear': 1975, 'Fuel Delivery - Carbureted': 1975,
+                 'Fuel Delivery - Gasoline Direct Injection (GDI)': 2008,
+                 'Fuel Delivery - Port Fuel Injection': 1980, 'Fuel Delivery - Throttle Body Injection': 1980,
+                 'Fuel Delivery - Other': 1975, 'Transmission - Manual': 1975,
+                 'Transmission - Automatic': 1975, 'Transmission - Continuously Variable (Non-Hybrid)': 1998,
+                 'Transmission - CVT (Hybrid)': 2000, 'Transmission - Other': 1975, '4 or Fewer Gears': 1975,
+                 '5 Gears': 1978, '6 Gears': 1990, '7 Gears': 2003, '8 Gears': 2007, '9 or More Gears': 2013,
+                 'Multivalve Engine': 1986, 'Turbocharged Engine': 1975, 'Stop/Start': 2012,
+                 'Cylinder Deactivation': 2005}
+
+def _share(rng, year, first_year):
+    """Return a production share, or '-' where the real table has no value."""
+    if year < first_year or rng.random() < 0.15:
+        return '-'
+    return '{:.3f}'.format(rng.random())
+
+def _row(rng, manufacturer, model_year, vehicle_type):
+    """Return one synthetic row with values in the ranges and formats of the real table."""
+    year = int(model_year[-4:])
+    progress = (year - 1975) / 47
+    mpg = rng.uniform(11, 16) + 12 * progress + rng.uniform(-2, 2)
+    weight = rng.uniform(3300, 4800) - 400 * progress
+    horsepower = rng.uniform(100, 150) + 150 * progress
+    footprint = '-' if year < 2008 else '{:.5f}'.format(rng.uniform(44, 66))
+    row = {
+        'Manufacturer': manufacturer,
+        'Model Year': model_year,
+        'Regulatory Class': 'Truck' if vehicle_type in ('All Truck', 'Truck SUV', 'Minivan/Van', 'Pickup') else
+                            'All' if vehicle_type == 'All' else 'Car',
+        'Vehicle Type': vehicle_type,
+        'Production Share': '{:.5f}'.format(rng.random()),
+        'Real-World MPG': '{:.4f}'.format(mpg),
+        'Real-World MPG_City': '{:.4f}'.format(mpg * 0.9),
+        'Real-World MPG_Hwy': '{:.4f}'.format(mpg * 1.2),
+        'Real-World CO2 (g/mi)': '{:.4f}'.format(8887 / mpg),
+        'Real-World CO2_City (g/mi)': '{:.4f}'.format(8887 / (mpg * 0.9)),
+        'Real-World CO2_Hwy (g/mi)': '{:.4f}'.format(8887 / (mpg * 1.2)),
+        'Weight (lbs)': '{:.4f}'.format(weight),
+        'Footprint (sq. ft.)': footprint,
+        'Engine Displacement': '{:.4f}'.format(rng.uniform(120, 320)),
+        'Horsepower (HP)': '{:.4f}'.format(horsepower),
+        'Acceleration (0-60 time in seconds)': '{:.4f}'.format(15 - 7 * progress + rng.uniform(-1, 1)),
+        'HP/Engine Displacement': '{:.6f}'.format(rng.uniform(0.4, 1.2)),
+        'HP/Weight (lbs)': '{:.6f}'.format(horsepower / weight),
+        '2-Cycle MPG': '{:.5f}'.format(mpg * 1.25),
+        'Average Number of Gears': '{:.1f}'.format(3 + 5 * progress),
+    }
+    for column, first_year in SHARE_COLUMNS.items():
+        row[column] = _share(rng, year, first_year)
+    return row
+
+def generate(path, scale=1, seed=0):
+    """
+    Write a synthetic Auto Trends CSV to `path`. Scale 1 has one row per manufacturer, model
+    year and vehicle type of the real table; scale N adds N - 1 renamed copies of every
+    manufacturer other than 'All', so the row count grows linearly. Returns the row count.
+    """
+    rng = random.Random(seed)
+    manufacturers = dict(MANUFACTURERS)
+    for copy in range(2, scale + 1):
+        for name, first_year in MANUFACTURERS.items():
+            if name != 'All':
+                manufacturers['{} {}'.format(name, copy)] = first_year
+    count = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        for manufacturer, first_year in manufacturers.items():
+            for model_year in YEARS:
+                if int(model_year[-4:]) < first_year:
+                    continue
+                for vehicle_type in VEHICLE_TYPES:
+                    writer.writerow(_row(rng, manufacturer, model_year, vehicle_type))
+                    count += 1
+    return count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic Auto Trends CSV.')
+    parser.add_argument('path', help='where to write the CSV')
+    parser.add_argument('--scale', type=int, default=1, help='multiple of the real table size')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print('Wrote {} rows to {}'.format(generate(args.path, args.scale, args.seed), args.path))
@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import redis
+import generate_data
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', 'src')
+
+# (name, method, path, JSON body) of every route that reads the data set or the jobs
+ROUTES = [
+    ('GET /help', 'get', '/help', None),
+    ('GET /data', 'get', '/data', None),
+    ('GET /data?format=ndjson', 'get', '/data?format=ndjson', None),
+    ('GET /data?format=csv', 'get', '/data?format=csv', None),
+    ('GET /data?format=arrow', 'get', '/data?format=arrow', None),
+    ('GET /data?format=parquet', 'get', '/data?format=parquet', None),
+    ('GET /data?limit=500', 'get', '/data?limit=500', None),
+    ('GET /years', 'get', '/years', None),
+    ('GET /years?start=&end=', 'get', '/years?start=2000&end=2010', None),
+    ('GET /years/<year>', 'get', '/years/2007', None),
+    ('GET /manufacturers', 'get', '/manufacturers', None),
+    ('GET /manufacturers/<manufacturer>', 'get', '/manufacturers/Toyota', None),
+    ('GET /manufacturers/<manufacturer>/years', 'get', '/manufacturers/Toyota/years', None),
+    ('GET /manufacturers/<manufacturer>/years/<year>', 'get', '/manufacturers/Toyota/years/2019', None),
+    ('GET /stats', 'get', '/stats?group_by=year,vehicle_type', None),
+    # the same job every time, so after the first request this times finding the existing job
+    ('POST /jobs', 'post', '/jobs', {'start': '1975', 'end': '2021'}),
+    ('GET /status/<jobid>', 'get', '/status/{jid}', None),
+    ('GET /status/<jobid>?wait=', 'get', '/status/{jid}?wait=1', None),
+    ('GET /download/<jobid>', 'get', '/download/{jid}', None),
+    ('GET /metrics', 'get', '/metrics', None),
+]
+# plot routes are measured twice, served from the cache and drawn from scratch
+PLOT_ROUTES = [
+    ('/co2_year_plot', '/co2_year_plot'),
+    ('/weight_mpg_plot/<year>', '/weight_mpg_plot/2010'),
+    ('/vehicleType_mpg_plot/<year>', '/vehicleType_mpg_plot/2015'),
+]
+
+class RoundTrips:
+    """Count redis round trips per thread by hooking the point where commands go on the wire."""
+
+    def __init__(self):
+        self._local = threading.local()
+        original = redis.connection.Connection.send_packed_command
+        counter = self
+
+        def send_packed_command(conn, command, check_health=True):
+            counter._local.count = counter.count() + 1
+            return original(conn, command, check_health)
+        redis.connection.Connection.send_packed_command = send_packed_command
+
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+def _summary(name, scale, rows, latencies, round_trips, errors, wall, concurrency):
+    """Summarize the measurements of one route at one scale."""
+    ms = np.array(latencies) * 1000
+    return {
+        'scale': scale,
+        'rows': rows,
+        'name': name,
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'errors': errors,
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'mean_ms': float(ms.mean()),
+        'max_ms': float(ms.max()),
+        'throughput_rps': len(latencies) / wall if wall else None,
+        'redis_round_trips': float(np.mean(round_trips)),
+    }
+
+def measure(counter, call, n, concurrency, setup=None):
+    """
+    Run `call` n times on `concurrency` threads. `setup` runs before each call and is not
+    measured. Returns the latencies, round trips per call, error count and wall time.
+    """
+    def one(_):
+        if setup is not None:
+            setup()
+        before = counter.count()
+        start = time.perf_counter()
+        ok = call()
+        return time.perf_counter() - start, counter.count() - before, ok
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(n)))
+    wall = time.perf_counter() - start
+    latencies, round_trips, oks = zip(*results)
+    return latencies, round_trips, oks.count(False), wall
+
+def run_scale(counter, scale, args, workdir):
+    """Benchmark every route and job execution against a data set of one scale."""
+    import auto_trends_api
+    import datastore
+    import jobs
+    import worker
+    app = auto_trends_api.app
+    clients = threading.local()
+
+    def request(method, path, body=None):
+        def call():
+            if not hasattr(clients, 'client'):
+                clients.client = app.test_client()
+            response = getattr(clients.client, method)(path, json=body)
+            response.get_data()
+            return response.status_code < 400
+        return call
+
+    rows = generate_data.generate(os.path.join(workdir, 'auto_trends_data.csv'), scale, args.seed)
+    # db 0 is left alone: its version counter must keep growing so nothing cached
+    # for an earlier scale is mistaken for this one
+    for pool in jobs._pools:
+        if pool.connection_kwargs['db'] != 0:
+            redis.Redis(connection_pool=pool).flushdb()
+    results = []
+    print('scale {}: {} rows'.format(scale, rows), file=sys.stderr)
+
+    load = measure(counter, request('post', '/data'), args.load_repeats, 1)
+    results.append(_summary('POST /data', scale, rows, *load, 1))
+
+    jid = jobs.add_job('1975', '2021', data_version=datastore.version())['id']
+    worker.execute_job(jid)
+
+    def execute():
+        new_jid = jobs._generate_jid()
+        jobs._save_job(jobs._generate_job_key(new_jid), jobs._instantiate_job(new_jid, 'submitted', '1975', '2021'))
+        worker.execute_job(new_jid)
+        return jobs.get_job_status(new_jid) == 'complete'
+    job_runs = measure(counter, execute, args.job_repeats, 1)
+    results.append(_summary('worker.execute_job', scale, rows, *job_runs, 1))
+
+    routes = [(name, method, path.format(jid=jid), body) for name, method, path, body in ROUTES]
+    for name, method, path, body in routes:
+        n = args.requests if not name.startswith('GET /data') or scale <= 10 else max(1, args.requests // 10)
+        request(method, path, body)()
+        results.append(_summary(name, scale, rows, *measure(counter, request(method, path, body), n, args.concurrency),
+                                args.concurrency))
+    for name, path in PLOT_ROUTES:
+        request('get', path)()
+        cached = measure(counter, request('get', path), args.requests, args.concurrency)
+        results.append(_summary('GET {} (cached)'.format(name), scale, rows, *cached, args.concurrency))
+        drawn = measure(counter, request('get', path), args.render_repeats, 1, setup=request('delete', path))
+        results.append(_summary('GET {} (render)'.format(name), scale, rows, *drawn, 1))
+    return results
+
+def compare(results, baseline_path, threshold):
+    """Return the measurements whose p95 latency regressed by more than `threshold` against a baseline run."""
+    with open(baseline_path) as f:
+        baseline = {(r['scale'], r['name']): r for r in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        before = baseline.get((result['scale'], result['name']))
+        if before and result['p95_ms'] > before['p95_ms'] * (1 + threshold):
+            regressions.append({'scale': result['scale'], 'name': result['name'],
+                                'baseline_p95_ms': before['p95_ms'], 'p95_ms': result['p95_ms']})
+    return regressions
+
+def use_fake_redis():
+    """
+    Point every connection pool of the API and the worker at one in-process fakeredis server.
+    Commands still go through the pooled connections, so round trips are counted as usual.
+    """
+    import fakeredis
+    import jobs
+    import metrics
+
+    class FakeConnection(fakeredis.FakeRedisConnection, metrics.InstrumentedConnection):
+        pass
+    server = fakeredis.FakeServer(version=(7,))
+    for pool in jobs._pools:
+        pool.reset()
+        pool.connection_class = FakeConnection
+        pool.connection_kwargs['server'] = server
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Auto Trends API routes and worker.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10],
+                        help='data set sizes as multiples of the real table (e.g. 1 10 100)')
+    parser.add_argument('--redis', default='127.0.0.1:6379',
+                        help='host:port of a scratch redis server, dbs 1 to 4 are flushed and db 0 is overwritten')
+    parser.add_argument('--flush', action='store_true',
+                        help='allow flushing the server given by --redis, which must hold nothing worth keeping')
+    parser.add_argument('--fake', action='store_true',
+                        help='run against an in-process fakeredis instead of a redis server (needs fakeredis and lupa)')
+    parser.add_argument('--requests', type=int, default=50, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=1, help='concurrent requests per route')
+    parser.add_argument('--load-repeats', type=int, default=3)
+    parser.add_argument('--render-repeats', type=int, default=10)
+    parser.add_argument('--job-repeats', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=os.path.join(HERE, 'results', 'bench-{}.json'.format(time.strftime('%Y%m%d-%H%M%S'))))
+    parser.add_argument('--baseline', default=None, help='earlier results file to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction by which p95 latency may grow before it counts as a regression')
+    args = parser.parse_args()
+    if not args.fake and not args.flush:
+        parser.error('the benchmark flushes dbs 1 to 4 of {} and overwrites db 0, '
+                     'pass --flush to allow it or --fake to use an in-process fakeredis'.format(args.redis))
+
+    host, port = args.redis.rsplit(':', 1)
+    os.environ['REDIS_IP'] = host
+    os.environ['REDIS_PORT'] = str(port)
+    sys.path.insert(0, SRC)
+    counter = RoundTrips()
+    if args.fake:
+        use_fake_redis()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            for scale in args.scales:
+                results.extend(run_scale(counter, scale, args, workdir))
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'redis': 'fakeredis' if args.fake else args.redis,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+        },
+        'results': results,
+    }
+    if args.baseline:
+        report['regressions'] = compare(results, args.baseline, args.threshold)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print('{:<52} {:>7} {:>9} {:>9} {:>9} {:>9} {:>7}'.format('route', 'rows', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'redis'))
+    for r in results:
+        print('{:<52} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>7.1f}'.format(
+            r['name'], r['rows'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['throughput_rps'] or 0, r['redis_round_trips']))
+    print('results written to {}'.format(args.output))
+    if report.get('regressions'):
+        for r in report['regressions']:
+            print('REGRESSION {} at scale {}: p95 {:.2f} ms -> {:.2f} ms'.format(
+                r['name'], r['scale'], r['baseline_p95_ms'], r['p95_ms']), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import argparse
+import csv
+import json
+import os
+import numpy as np
+import datastore
+
+# Build step that turns the CSV into a directory of typed column files, opened memory mapped
+# by the API and the worker so every process on a host shares one read only copy of the
+# parsed data set in the page cache
+ARTIFACT_DIR = os.environ.get('DATA_ARTIFACT', 'auto_trends_data')
+MANIFEST = 'manifest.json'
+FORMAT = 1
+MISSING = '-'
+# low cardinality text columns, stored as small integer codes into a list of their values
+DICTIONARY_COLUMNS = ('Manufacturer', 'Model Year', 'Regulatory Class', 'Vehicle Type')
+
+def _read_csv(path):
+    """
+    Return the column names and rows of the CSV at `path`. A row whose key repeats an
+    earlier one replaces it, as it does when the CSV is loaded into redis.
+    """
+    with open(path, 'r') as f:
+        reader = csv.DictReader(f)
+        rows = {datastore.row_key(item): item for item in reader}
+        return reader.fieldnames or [], list(rows.values())
+
+def _numeric(values):
+    """Return a text column as floats with NaN where it is '-', or None if it is not numeric."""
+    try:
+        return np.where(values == MISSING, 'nan', values).astype(float)
+    except ValueError:
+        return None
+
+def _years(values):
+    """Return the Model Year column as floats, NaN for values like 'Prelim. 2022'."""
+    digits = np.array([year.isdigit() for year in values], dtype=bool)
+    return np.where(digits, values, 'nan').astype(float)
+
+def _code_dtype(size):
+    """Return the smallest integer type that can number `size` dictionary values."""
+    return np.uint8 if size <= 1 << 8 else np.uint16 if size <= 1 << 16 else np.uint32
+
+def build(csv_path, out_dir=ARTIFACT_DIR):
+    """
+    Write the artifact for the CSV at `csv_path` into `out_dir`. Every column is one .npy
+    file of fixed width strings, or of dictionary codes for DICTIONARY_COLUMNS, plus a float
+    file for numeric columns. The manifest is written last so a half written artifact is
+    never opened. Returns the manifest.
+    """
+    columns, rows = _read_csv(csv_path)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {'format': FORMAT, 'source': datastore.file_checksum(csv_path), 'rows': len(rows),
+                'columns': columns, 'dictionary': {}, 'numeric': []}
+    for i, name in enumerate(columns):
+        values = np.array([row.get(name, MISSING) for row in rows], dtype=str)
+        if name in DICTIONARY_COLUMNS:
+            categories, codes = np.unique(values, return_inverse=True)
+            manifest['dictionary'][name] = categories.tolist()
+            np.save(os.path.join(out_dir, '{}.codes.npy'.format(i)), codes.astype(_code_dtype(len(categories))))
+        else:
+            np.save(os.path.join(out_dir, '{}.text.npy'.format(i)), values)
+        numeric = _numeric(values)
+        if numeric is not None:
+            manifest['numeric'].append(name)
+            np.save(os.path.join(out_dir, '{}.values.npy'.format(i)), numeric)
+        if name == 'Model Year':
+            np.save(os.path.join(out_dir, 'year.npy'), _years(values))
+    with open(os.path.join(out_dir, MANIFEST + '.tmp'), 'w') as f:
+        json.dump(manifest, f)
+    os.replace(os.path.join(out_dir, MANIFEST + '.tmp'), os.path.join(out_dir, MANIFEST))
+    return manifest
+
+class Artifact:
+    """
+    Read only, memory mapped view of a built artifact. Arrays are mapped lazily and shared
+    by every process that opens the same directory.
+    """
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.source = manifest['source']
+        self.rows = manifest['rows']
+        self.columns = manifest['columns']
+        self.categories = {name: np.array(values, dtype=object) for name, values in manifest['dictionary'].items()}
+        self.numeric_columns = manifest['numeric']
+
+    def _load(self, kind, name):
+        """Map one column file."""
+        index = self.columns.index(name)
+        return np.load(os.path.join(self.path, '{}.{}.npy'.format(index, kind)), mmap_mode='r')
+
+    def codes(self, name):
+        """Return the dictionary codes of a column in DICTIONARY_COLUMNS."""
+        return self._load('codes', name)
+
+    def text(self, name):
+        """Return a column as strings."""
+        if name in self.categories:
+            return self.categories[name][self.codes(name)]
+        return self._load('text', name)
+
+    def values(self, name):
+        """Return a numeric column as floats, NaN where the value is missing."""
+        return self._load('values', name)
+
+    def year(self):
+        """Return the Model Year column as floats, NaN where it is not a number."""
+        if 'Model Year' not in self.columns:
+            return np.empty(0)
+        return np.load(os.path.join(self.path, 'year.npy'), mmap_mode='r')
+
+    def iter_rows(self):
+        """Yield every row as a dict of its original strings."""
+        text = [self.text(name).tolist() for name in self.columns]
+        for values in zip(*text):
+            yield dict(zip(self.columns, values))
+
+def open_artifact(path=ARTIFACT_DIR):
+    """Return the artifact in `path`, or None if there is no complete artifact there."""
+    try:
+        with open(os.path.join(path, MANIFEST), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('format') != FORMAT:
+        return None
+    return Artifact(path, manifest)
+
+def load(csv_path, path=ARTIFACT_DIR):
+    """
+    Load the data set into redis from the artifact in `path` if it was built from the CSV
+    at `csv_path`, or from the CSV itself otherwise. Returns what datastore.load_rows does.
+    """
+    data = open_artifact(path)
+    if data is not None and (not os.path.exists(csv_path) or datastore.file_checksum(csv_path) == data.source):
+        return datastore.load_rows(data.columns, data.iter_rows(), data.source)
+    return datastore.load_csv(csv_path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the memory mapped column artifact of the Auto Trends CSV.')
+    parser.add_argument('csv', help='path of the Auto Trends CSV')
+    parser.add_argument('out', nargs='?', default=ARTIFACT_DIR, help='directory to write the artifact to')
+    args = parser.parse_args()
+    manifest = build(args.csv, args.out)
+    print('Wrote {} rows and {} columns to {}'.format(manifest['rows'], len(manifest['columns']), args.out))
+
+if __name__ == '__main__':
+    main()
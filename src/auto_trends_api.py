@@ -1,36 +1,170 @@
-from flask import Flask, request, send_file, render_template
+from flask import Flask, request, render_template, Response, g
 import os
 import requests
-import redis
-import csv
-import matplotlib.pyplot as plt
-import numpy as np
 import json
-from jobs import rd, rd2, rd3, add_job
+import math
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+from werkzeug.http import http_date, is_resource_modified
+from jobs import rd3, q, add_job, count_new_jobs, get_job_status, get_job_image, queue_is_full, RESULTS_BYTES_KEY, FINAL_STATUSES, PRIORITIES
+import artifact
+import datastore
+import dataset
+import export
+import job_events
+import metrics
+import plot_cache
+import response_cache
+import plots
+import stats
 
 app = Flask(__name__)
 
+# longest a /status request may wait for a job to finish, and how often an idle job event
+# stream sends a comment so proxies keep it open
+MAX_STATUS_WAIT = float(os.environ.get('MAX_STATUS_WAIT', '60'))
+STATUS_KEEPALIVE = float(os.environ.get('STATUS_KEEPALIVE', '15'))
+# seconds a client is told to wait before submitting again when the job queue is full
+JOB_RETRY_AFTER = int(os.environ.get('JOB_RETRY_AFTER', '30'))
+# query parameters that change the JSON body of a route, the others are left out of its cache key
+BODY_PARAMETERS = ('year', 'manufacturer', 'vehicle_type', 'start', 'end', 'fields')
+
+@app.before_request
+def _start_request():
+    """Starts timing the request and counting its redis calls"""
+    g.request_start = time.perf_counter()
+    metrics.reset_redis_usage()
+
+@app.after_request
+def _record_request(response):
+    """
+    Records the latency, status and redis usage of the request once its body has been sent,
+    so streamed responses are timed in full
+
+    Args:
+        response: the Flask response of the request
+    Returns:
+        response: the same response
+    """
+    labels = {'method': request.method, 'route': request.url_rule.rule if request.url_rule else 'unmatched'}
+    status = response.status_code
+    start = g.request_start
+    def record():
+        calls, seconds = metrics.redis_usage()
+        metrics.inc('http_requests_total', dict(labels, status=status))
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - start, labels)
+        metrics.inc('http_request_redis_calls_total', labels, calls)
+        metrics.inc('http_request_redis_seconds_total', labels, seconds)
+        metrics.maybe_flush(rd3)
+    response.call_on_close(record)
+    return response
+
+def _validate_job(job) -> str:
+    """
+    Checks the parameters of one job
+
+    Args:
+        job (dict): the JSON description of a job with its start and end years
+    Returns:
+        error (str): the message describing what is wrong with the job, None if it is valid
+    """
+    if not 1975 <= int(job['start']) <= 2021:
+        return 'Invalid start date, please enter a valid year between 1975 and 2021\n'
+    if not 1975 <= int(job['end']) <= 2021:
+        return 'Invalid end date, please enter a valid year between 1975 and 2021\n'
+    if int(job['start']) > int(job['end']):
+        return 'Invalid date range, the start year must not be after the end year\n'
+    if job.get('priority', 'normal') not in PRIORITIES:
+        return 'Invalid priority, please enter one of {}\n'.format(', '.join(PRIORITIES))
+    return None
+
+def _cache_path() -> str:
+    """
+    Returns the request path with only the query parameters that change a JSON body, in a
+    fixed order, so requests that differ only in other parameters share one cached body
+
+    Args:
+        N/A
+    Returns:
+        path (str): the path and normalized query the body is cached under
+    """
+    return request.path + '?' + urlencode([(name, request.args[name]) for name in BODY_PARAMETERS
+                                           if name in request.args])
+
+def _versioned_json(build):
+    """
+    Returns a JSON response tagged with the data set version, so clients can revalidate it.
+    When the client already has this version it gets 304 Not Modified without the body
+    being built, otherwise the body is built, compressed and cached once per version
+
+    Args:
+        build (function): returns the list or dictionary to send, raises ValueError for an invalid query
+    Returns:
+        response: the Flask response
+    """
+    data_version, updated_at = datastore.version_info()
+    etag = 'W/"{}"'.format(data_version)
+    headers = {'ETag': etag, 'Vary': 'Accept, Accept-Encoding', 'Cache-Control': 'no-cache'}
+    last_modified = None
+    if updated_at is not None:
+        last_modified = datetime.fromtimestamp(updated_at, timezone.utc)
+        headers['Last-Modified'] = http_date(last_modified)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return Response(status=304, headers=headers)
+    encoding = next((e for e in response_cache.encodings() if request.accept_encodings[e]), 'identity')
+    def build_body():
+        body = app.json.response(build()).get_data()
+        if datastore.version() != data_version:
+            # a load or delete landed while the body was built, it is not cached for this version
+            raise response_cache.VersionChanged()
+        return body
+    try:
+        body, encoding = response_cache.get_or_build(_cache_path(), data_version, encoding, build_body)
+    except response_cache.VersionChanged:
+        return _versioned_json(build)
+    except ValueError as e:
+        return 'Invalid query: {}\n'.format(e), 400
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(body, mimetype='application/json', headers=headers)
+
 @app.route('/jobs', methods=['POST'])
 def jobs_api():
       """
-      Creates a new job to do some analysis, accepts a JSON payload describing the job to be created
+      Creates a new job to do some analysis, accepts a JSON payload describing the job to be created.
+      Also accepts a list of jobs, or {"jobs": [...]}, to create many jobs in one call. A job that is
+      identical to one already queued, running or complete on the same data is not created again,
+      the existing job is returned instead. A job may set "priority" to high, normal or low. Nothing
+      is queued while the queue holds more than JOB_QUEUE_MAX_DEPTH jobs, the answer is then 503.
 
       Args:
           N/A
       Returns:
           output (dict): if valid JSON input is entered, returns JSON output with job information
+                         (a list of them when a list of jobs was submitted)
       """
       try:
-          job = request.get_json(force=True)
-          if not 1975 <= int(job['start']) <= 2021:
-              return 'Invalid start date, please enter a valid year between 1975 and 2021\n'
-          if not 1975 <= int(job['end']) <= 2021:
-              return 'Invalid end date, please enter a valid year between 1975 and 2021\n'
-          if len(rd.keys()) == 0:
+          body = request.get_json(force=True)
+          if isinstance(body, dict) and 'jobs' in body:
+              body = body['jobs']
+          job_list = body if isinstance(body, list) else [body]
+          for job in job_list:
+              error = _validate_job(job)
+              if error:
+                  return error, 400
+          if not datastore.is_loaded():
             return 'Auto Trends data not loaded in Redis yet\n'
       except Exception as e:
-          return True, json.dumps({'status': "Error", 'message': 'Invalid JSON: {}.'.format(e)})
-      return json.dumps(add_job(job['start'], job['end'])) + '\n'
+          return json.dumps({'status': "Error", 'message': 'Invalid JSON: {}.'.format(e)}) + '\n', 400
+      data_version = datastore.version()
+      new_jobs = count_new_jobs([(job['start'], job['end']) for job in job_list], data_version)
+      if new_jobs and queue_is_full(new_jobs):
+          metrics.inc('jobs_rejected_total')
+          return 'The job queue is full, please try again later\n', 503, {'Retry-After': str(JOB_RETRY_AFTER)}
+      output = [add_job(job['start'], job['end'], data_version=data_version, priority=job.get('priority', 'normal'))
+                for job in job_list]
+      return json.dumps(output if isinstance(body, list) else output[0]) + '\n'
 
 @app.route('/data', methods=['POST','GET','DELETE'])
 def handle_data() -> list:
@@ -39,64 +173,104 @@ def handle_data() -> list:
     If method is GET, returns data from redis
     If method is DELETE, clears the data in redis and returns message
 
+    GET accepts these optional query parameters:
+        cursor, limit: return one page of rows as {"data": [...], "next_cursor": ...}
+        format=ndjson: stream the rows as newline delimited JSON
+        format=csv, arrow or parquet: download the rows in that format, also chosen by the
+            Accept header
+        stream=true: stream the rows as a single JSON list
+        year, start, end, manufacturer, vehicle_type: only return the matching rows, year,
+            manufacturer and vehicle_type take comma separated lists
+        fields: comma separated list of the columns to return
+
     Args:
         N/A
     Returns:
         auto_data (list): (if method is GET) list of dictionaries of the cars data in redis
     """
     if request.method == 'POST':
-        with open('auto_trends_data.csv', 'r') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                item = dict(row)
-                key = item['Manufacturer'] + '-' + item['Model Year'] + '-' + item['Vehicle Type']
-                rd.hset(key, mapping = item)
-        return 'Auto Trends data is loaded into Redis\n'
+        result = artifact.load('auto_trends_data.csv')
+        if result is None:
+            return 'Auto Trends data is already being loaded, please try again shortly\n'
+        count, seconds = result
+        return ('Auto Trends data is loaded into Redis\n'
+                'Loaded {} rows in {:.3f} seconds ({:.0f} rows/sec)\n'.format(count, seconds, count / seconds if seconds else 0))
     elif request.method == 'GET':
-        auto_data = []
-        for key in rd.keys():
-            auto_data.append(rd.hgetall(key))
-        return auto_data
+        try:
+            filters = _row_filters()
+            fields = _list_arg('fields') or None
+        except ValueError as e:
+            return 'Invalid query: {}\n'.format(e), 400
+        if 'cursor' in request.args or 'limit' in request.args:
+            try:
+                limit = int(request.args.get('limit', datastore.SCAN_BATCH_SIZE))
+                if limit < 1:
+                    raise ValueError('limit must be at least 1')
+                keys = datastore.select_keys(**filters) if filters else None
+                rows, next_cursor = datastore.page_rows(request.args.get('cursor'), limit, keys, fields)
+            except ValueError as e:
+                return 'Invalid cursor or limit: {}\n'.format(e), 400
+            if request.args.get('format') == 'ndjson':
+                return Response(_ndjson(rows), mimetype='application/x-ndjson',
+                                headers={'X-Next-Cursor': next_cursor or ''})
+            return {'data': rows, 'next_cursor': next_cursor}
+        if request.args.get('format') == 'ndjson' or request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+            try:
+                datastore.check_fields(fields)
+            except ValueError as e:
+                return 'Invalid query: {}\n'.format(e), 400
+            rows = datastore.iter_rows(keys=datastore.select_keys(**filters) if filters else None, fields=fields)
+            if request.args.get('format') == 'ndjson':
+                return Response(_ndjson(rows), mimetype='application/x-ndjson')
+            return Response(_json_list(rows), mimetype='application/json')
+        return _rows_response()
     elif request.method == 'DELETE':
-        rd.flushdb()
+        datastore.clear()
         return 'Auto Trends data has been deleted from Redis\n'
     else:
         return 'The method you tried does not work\n'
 
+def _ndjson(rows):
+    """Yield each row as one line of JSON."""
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+def _json_list(rows):
+    """Yield the rows as the pieces of one JSON list."""
+    yield '['
+    for i, row in enumerate(rows):
+        yield (',' if i else '') + json.dumps(row)
+    yield ']\n'
+
 @app.route('/years', methods=['GET'])
 def get_years() -> list:
     """
     Returns a list of the years currently in redis for the Auto Trends database for the '/years' route
-    
+    With ?start=<year>&end=<year>, either of which may be left out, only returns the numeric
+    years in that range, from the year range index
+
     Args:
         N/A
     Returns:
         years_list (list): list of strings of the Model Year
     """
-    years_list = []
-    for key in rd.keys():
-        car_dict = rd.hgetall(key)
-        if car_dict['Model Year'] not in years_list:
-            years_list.append(car_dict['Model Year'])
-    return years_list
+    if 'start' in request.args or 'end' in request.args:
+        return _versioned_json(lambda: datastore.years_between(
+            *[int(request.args[name]) if name in request.args else None for name in ('start', 'end')]))
+    return _versioned_json(datastore.years)
 
 @app.route('/years/<year>', methods=['GET'])
 def get_year_info(year: str) -> list:
     """
     Returns a list with all cars from that year if found in the Auto Trends database for the '/years/<year>' route
+    Accepts the filter and fields query parameters of GET /data to narrow down the rows
 
     Args:
         year (str): the string of a Model Year
     Returns:
         year_cars (list): list with cars from the specified year, if year not found, will be empty list
     """
-    year_cars = []
-    if year in get_years():
-        for key in rd.keys():
-            car_dict = rd.hgetall(key)
-            if car_dict['Model Year'] == year:
-                year_cars.append(car_dict)
-    return year_cars
+    return _rows_response(years=[year])
 
 @app.route('/manufacturers', methods=['GET'])
 def get_manufacturers() -> list:
@@ -108,30 +282,20 @@ def get_manufacturers() -> list:
     Returns:
         manufacturers_list (list): list of strings of the Manufacturer
     """
-    manufacturers_list = []
-    for key in rd.keys():
-        car_dict = rd.hgetall(key)
-        if car_dict['Manufacturer'] not in manufacturers_list:
-            manufacturers_list.append(car_dict['Manufacturer'])
-    return manufacturers_list
+    return _versioned_json(datastore.manufacturers)
 
 @app.route('/manufacturers/<manufacturer>', methods=['GET'])
 def get_manufacturer_info(manufacturer: str) -> list:
     """
     Returns a list with all cars from that manufacturer if found in the Auto Trends database for the '/manufacturers/<manufacturer>' route
+    Accepts the filter and fields query parameters of GET /data to narrow down the rows
 
     Args:
         manufacturer (str): the string of a Manufacturer
     Returns:
         manufacturer_cars (list): list with cars from the specified manufacturer, if manufacturer not found, will be empty list
     """
-    manufacturer_cars = []
-    if manufacturer in get_manufacturers():
-        for key in rd.keys():
-            car_dict = rd.hgetall(key)
-            if car_dict['Manufacturer'] == manufacturer:
-                manufacturer_cars.append(car_dict)
-    return manufacturer_cars
+    return _rows_response(manufacturers=[manufacturer])
 
 @app.route('/manufacturers/<manufacturer>/years', methods=['GET'])
 def manu_years(manufacturer: str) -> list:
@@ -143,17 +307,13 @@ def manu_years(manufacturer: str) -> list:
     Returns:
         years_list (list): list with years from the specified manufacturer, if manufacturer not found, will be empty list
     """
-    years_list = []
-    cars_list = get_manufacturer_info(manufacturer)
-    for car in cars_list:
-        if car['Model Year'] not in years_list:
-            years_list.append(car['Model Year'])
-    return years_list
+    return _versioned_json(lambda: datastore.manufacturer_years(manufacturer))
 
 @app.route('/manufacturers/<manufacturer>/years/<year>', methods=['GET'])
 def manu_years_data(manufacturer: str, year: str) -> list:
     """
     Returns a list for the data for the specified manufacturer and year if found in the Auto Trends database for the '/manufacturers/<manufacturer>/years/<year>' route
+    Accepts the filter and fields query parameters of GET /data to narrow down the rows
 
     Args:
         manufacturer (str): the string of a Manufacturer
@@ -161,18 +321,186 @@ def manu_years_data(manufacturer: str, year: str) -> list:
     Returns:
         data_list (list): list with data for the year from the specified manufacturer, if manufacturer or year not found, will be empty list
     """
-    data_list = []
-    cars_list = get_manufacturer_info(manufacturer)
-    for car in cars_list:
-        if car['Model Year'] == year:
-            data_list.append(car)
-    return data_list
+    return _rows_response(manufacturers=[manufacturer], years=[year])
+
+def _list_arg(name: str) -> list:
+    """
+    Returns a comma separated query parameter as a list
+
+    Args:
+        name (str): the name of the query parameter
+    Returns:
+        values (list): the non empty values of the parameter, empty list if it is not given
+    """
+    return [value.strip() for value in request.args.get(name, '').split(',') if value.strip()]
+
+def _row_filters() -> dict:
+    """
+    Returns the row filters given as query parameters: year, manufacturer and vehicle_type
+    (comma separated lists) and start and end (a range of Model Years)
+
+    Args:
+        N/A
+    Returns:
+        filters (dict): the filters that are given, as keyword arguments of datastore.select_keys
+    """
+    filters = {}
+    for name, arg in (('years', 'year'), ('manufacturers', 'manufacturer'), ('vehicle_types', 'vehicle_type')):
+        if arg in request.args:
+            filters[name] = _list_arg(arg)
+    for name in ('start', 'end'):
+        if name in request.args:
+            filters[name] = int(request.args[name])
+    return filters
+
+def _filtered_rows(filters: dict, fields: list = None) -> list:
+    """
+    Returns the rows matching the filters, selected from the indexes
+
+    Args:
+        filters (dict): keyword arguments of datastore.select_keys
+        fields (list): the columns to return, all of them if None
+    Returns:
+        rows (list): list of dictionaries of the matching rows
+    """
+    return datastore.fetch_rows(datastore.select_keys(**filters), fields)
+
+def _route_rows(**fixed) -> list:
+    """
+    Returns the rows of a route matching its own filters, narrowed down by any filters and
+    fields given as query parameters. Raises ValueError for an invalid query
+
+    Args:
+        fixed: the filters set by the route path, which take precedence over the query parameters
+    Returns:
+        rows (list): list of dictionaries of the matching rows
+    """
+    filters = _row_filters()
+    filters.update(fixed)
+    return _filtered_rows(filters, _list_arg('fields') or None)
+
+def _rows_response(**fixed):
+    """
+    Returns the rows of a route like _route_rows, as JSON or in the export format asked for
+    with ?format=csv|arrow|parquet or the Accept header
+
+    Args:
+        fixed: the filters set by the route path, which take precedence over the query parameters
+    Returns:
+        response: the Flask response
+    """
+    name = export.negotiate(request.args.get('format'), request.accept_mimetypes)
+    if name is None:
+        return _versioned_json(lambda: _route_rows(**fixed))
+    if not export.available(name):
+        return 'The {} format needs pyarrow, which is not installed\n'.format(name), 406
+    data = dataset.get_dataset()
+    # each format has its own tag, a cache must not answer a CSV request with a Parquet file
+    etag = 'W/"{}-{}"'.format(data.version, name)
+    headers = {'ETag': etag, 'Vary': 'Accept, Accept-Encoding', 'Cache-Control': 'no-cache'}
+    if not is_resource_modified(request.environ, etag=etag):
+        return Response(status=304, headers=headers)
+    mimetype, extension = export.FORMATS[name]
+    headers['Content-Disposition'] = 'attachment; filename=auto_trends_data.{}'.format(extension)
+    try:
+        filters = _row_filters()
+        filters.update(fixed)
+        body = export.stream(name, data, data.select(**filters), _list_arg('fields') or None)
+    except ValueError as e:
+        return 'Invalid query: {}\n'.format(e), 400
+    return Response(body, mimetype=mimetype, headers=headers)
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """
+    Returns aggregate statistics of the numeric columns, grouped by any of year, manufacturer
+    and vehicle type, for the '/stats' route
+
+    Query parameters (all optional):
+        group_by: comma separated list of year, manufacturer, vehicle_type
+        columns: comma separated list of numeric columns, defaults to MPG, CO2, weight, horsepower and production share
+        aggregates: comma separated list of count, mean, min, max, weighted_mean, harmonic_mean, defaults to all of them
+        year, start, end, manufacturer, vehicle_type: only use the matching rows, as for '/data'
+
+    Args:
+        N/A
+    Returns:
+        groups (list): one dictionary per group with its field values and the aggregates of every column
+    """
+    data = dataset.get_dataset()
+    if not len(data):
+        return 'Auto Trends data not loaded in Redis yet\n'
+    try:
+        rows = data.select(**_row_filters())
+        return stats.aggregate(data, rows, _list_arg('group_by'), _list_arg('columns'), _list_arg('aggregates'))
+    except ValueError as e:
+        return 'Invalid query: {}\n'.format(e), 400
+
+def _png_response(data: bytes, filename: str):
+    """
+    Returns a PNG image as a file download
+
+    Args:
+        data (bytes): the PNG image
+        filename (str): the name of the downloaded file
+    Returns:
+        response: the Flask response sending the image
+    """
+    return Response(data, mimetype='image/png', headers={
+        'Content-Disposition': 'attachment; filename={}'.format(filename),
+        'Content-Length': str(len(data)),
+    })
+
+def _render_co2_year_plot() -> bytes:
+    """
+    Draws the average CO2 emissions of all vehicles for every year from 1975 to 2021
+
+    Args:
+        N/A
+    Returns:
+        file_bytes (bytes): the PNG image of the plot
+    """
+    data = dataset.get_dataset()
+    rows = data.mask(start=1975, end=2021, manufacturer='All', vehicle_type='All')
+    years = data.year[rows]
+    co2 = data.values('Real-World CO2 (g/mi)')[rows]
+    return plots.co2_year_plot(years, co2)
+
+def _render_weight_mpg_plot(year: str) -> bytes:
+    """
+    Draws the weight against the fuel economy of every vehicle from a year
+
+    Args:
+        year (str): the string of the Model Year
+    Returns:
+        file_bytes (bytes): the PNG image of the plot
+    """
+    data = dataset.get_dataset()
+    rows = data.mask(year=year) & data.present('Real-World MPG') & data.present('Weight (lbs)')
+    mpg_list = data.values('Real-World MPG')[rows]
+    weight_list = data.values('Weight (lbs)')[rows]
+    return plots.weight_mpg_plot(year, weight_list, mpg_list)
+
+def _render_vehicle_type_mpg_plot(year: str) -> bytes:
+    """
+    Draws the fuel economy of every vehicle type from a year
+
+    Args:
+        year (str): the string of the Model Year
+    Returns:
+        file_bytes (bytes): the PNG image of the plot
+    """
+    data = dataset.get_dataset()
+    rows = data.mask(year=year, manufacturer='All') & data.present('Real-World MPG')
+    x = list(data.strings('Vehicle Type', rows))
+    y = data.values('Real-World MPG')[rows]
+    return plots.vehicle_type_mpg_plot(year, x, y)
 
 @app.route('/co2_year_plot', methods=['GET', 'POST', 'DELETE'])
 def image_func() -> bytes:
     """
     If method is POST, loads a simple plot of the auto trends data into redis and returns message
-    If method is GET, returns image from redis
+    If method is GET, returns image from redis, drawing it first if it is not cached yet
     If method is DELETE, clears the image in redis and returns message
 
     Args:
@@ -181,39 +509,21 @@ def image_func() -> bytes:
         auto_img (bytes): (if method is GET) bytes object of the image for the data set
     """
     if request.method == 'POST':
-        if len(rd.keys()) == 0:
+        if not datastore.is_loaded():
             return 'Auto Trends data has not been loaded in Redis yet\n'
         else:
-            cars_list = get_manufacturer_info('All')
-            years = []
-            co2 = []
-            for car in cars_list:
-                if car['Vehicle Type'] == 'All':
-                    if car['Model Year'].isdigit() and 1975 <= int(car['Model Year']) <= 2021:
-                        years.append(int(car['Model Year']))
-                        co2.append(float(car['Real-World CO2 (g/mi)']))
-            plt.scatter(years, co2)
-            plt.title('Average Vehicle CO2 Emissions from 1975-2021')
-            plt.ylabel('Real-World CO2 (g/mi)')
-            plt.xlabel('Year')
-            plt.savefig('./co2_graph.png')
-            plt.clf()
-            file_bytes = open('./co2_graph.png', 'rb').read()
-            rd2.set('image0', file_bytes)
+            plot_cache.get_or_render('co2_year_plot', {}, _render_co2_year_plot)
             return 'Image is loaded into Redis\n'
     elif request.method == 'GET':
-        if b'image0' not in rd2.keys():
-            return 'Image is not in the database, please run the POST method first\n'
+        if not datastore.is_loaded():
+            return 'Auto Trends data has not been loaded in Redis yet\n'
         else:
-            path = './getimage.png'
-            with open(path, 'wb') as f:
-                f.write(rd2.get('image0'))
-            return send_file(path, mimetype='image/png', as_attachment=True)
+            file_bytes = plot_cache.get_or_render('co2_year_plot', {}, _render_co2_year_plot)
+            return _png_response(file_bytes, 'co2_graph.png')
     elif request.method == 'DELETE':
-        if b'image0' not in rd2.keys():
+        if not plot_cache.delete('co2_year_plot', {}):
             return 'Image is not in the database, please run the POST method first\n'
         else:
-            rd2.delete('image0')
             return 'Auto Trends data image has been deleted from Redis\n'
     else:
         return 'The method you tried does not work\n'
@@ -225,114 +535,54 @@ def disp_image(year: str) -> bytes:
     Downloads an image of a plot that compares a vehicles weight to its fuel efficiency from the year specified by the user
     
     Args:
-        manufacturer (str): the string of a Manufacturer
         year (str): the string of the Model Year
     Returns:
         auto_img (bytes): (if method is GET) bytes object of the image for the data set
     """
-    if request.method == 'POST':
-        mpg_list = []
-        weight_list = []
-        output_list = []
-        for item in rd.keys():
-            output_list.append(rd.hgetall(item))
-        if output_list == []:
-            return 'Auto Trends data is not loaded into Redis yet\n'
-        else:
-            years_list = get_years()
-            if year not in years_list and not year.isdigit():
-                return 'Invalid input, please choose a valid year from 1975 to 2021\n'
-            for key in rd.keys():
-                yr = rd.hget(key, 'Model Year')
-                if yr.isdigit() and int(yr) == int(year):
-                    mpg = rd.hget(key, 'Real-World MPG')
-                    weight = rd.hget(key, 'Weight (lbs)')
-                    if mpg != '-' and weight != '-':
-                        mpg_list.append(float(mpg))
-                        weight_list.append(float(weight))
-            plt.scatter(weight_list, mpg_list)
-            plt.title('Vehicle Weight vs Fuel Economy in ' + year)
-            plt.xlabel('Weight (lbs)')
-            plt.ylabel('Miles per Gallon')
-            plt.savefig('./weight_mpg_plt_year.png')
-            plt.clf()
-            file_bytes = open('./weight_mpg_plt_year.png', 'rb').read()
-            # set the file bytes as a key in Redis
-            rd2.set('plotimage', file_bytes)
-            return 'Image has been loaded to Redis\n'
-    elif request.method == 'GET':
-        # check if image is in database
-        # if so, return image
-        if rd2.exists('plotimage'):
-            path='./weight_mpg_plt_year.png'
-            with open(path,'wb') as f:
-                f.write(rd2.get('plotimage'))
-            return send_file(path, mimetype='image/png', as_attachment=True)
-        else:
-            return 'Image is not in the database, please run the POST method first\n'
-    elif request.method == 'DELETE':
+    params = {'year': year}
+    if request.method == 'DELETE':
         # delete image from redis
-        if rd2.exists('plotimage'):
-            rd2.delete('plotimage')
+        if plot_cache.delete('weight_mpg_plot', params):
             return 'The image has been deleted\n'
         else:
             return 'Image is not in the database, please run the POST method first\n'
+    if not datastore.is_loaded():
+        return 'Auto Trends data is not loaded into Redis yet\n'
+    if not year.isdigit():
+        return 'Invalid input, please choose a valid year from 1975 to 2021\n'
+    file_bytes = plot_cache.get_or_render('weight_mpg_plot', params, lambda: _render_weight_mpg_plot(year))
+    if request.method == 'POST':
+        return 'Image has been loaded to Redis\n'
+    else:
+        return _png_response(file_bytes, 'weight_mpg_plt_{}.png'.format(year))
 
 @app.route('/vehicleType_mpg_plot/<year>', methods=['POST','GET','DELETE'])
 def showPlot(year: str) -> bytes:
     """
     If method is POST, loads a simple plot of the auto trends data into redis and returns message
-    If method is GET, returns image from redis
+    If method is GET, returns image from redis, drawing it first if it is not cached yet
     If method is DELETE, clears the image in redis and returns message
 
     Args:
-        N/A
+        year (str): the string of the Model Year
     Returns:
         auto_img (bytes): (if method is GET) bytes object of the image for the data set
     """
-    years_list = get_years()
-    if request.method == 'POST':
-        if len(rd.keys()) == 0:
-            return 'Auto Trends data is not loaded into Redis yet\n'
-        else:
-            x = []
-            y = []
-            if year not in years_list and not year.isdigit():
-                return 'Invalid input, please enter a valid year from 1975 to 2021\n'
-            for key in rd.keys():
-                carDict = rd.hgetall(key)
-                yr = carDict['Model Year']
-                if carDict['Manufacturer'] == 'All' and yr.isdigit() and int(yr) == int(year):
-                    mpg = carDict['Real-World MPG']
-                    carType = carDict['Vehicle Type']
-                    if mpg != '-':
-                        x.append(carType)
-                        y.append(float(mpg))
-            plt.bar(x, y, color = 'g', width = 0.72, label = "MPG")
-            plt.xlabel('Vehicle Type')
-            plt.ylabel('MPG')
-            plt.title(year + ': MPG vs Vehicle Type')
-            plt.legend()
-            plt.savefig('./2021_MPGvType.png')
-            plt.clf()
-            file_bytes = open('./2021_MPGvType.png', 'rb').read()
-            # set the file bytes as a key in Redis
-            rd2.set('plot', file_bytes)
-            return 'Plot is loaded into Redis.\n'
-    elif request.method == 'GET':
-        if rd2.exists('plot'):
-            path = './2021_MPGvType.png'
-            with open(path, 'wb') as f:
-                f.write(rd2.get('plot'))
-            return send_file(path, mimetype='image/png', as_attachment=True)
-        else:
-            return 'Image is not in the database, please run the POST method first\n'
-    elif request.method == 'DELETE':
-        if rd2.exists('plot'):
-            rd2.delete('plot')
+    params = {'year': year}
+    if request.method == 'DELETE':
+        if plot_cache.delete('vehicleType_mpg_plot', params):
             return 'Plot has been deleted\n'
         else:
             return 'Image is not in the database, please run the POST method first\n'
+    if not datastore.is_loaded():
+        return 'Auto Trends data is not loaded into Redis yet\n'
+    if not year.isdigit():
+        return 'Invalid input, please enter a valid year from 1975 to 2021\n'
+    file_bytes = plot_cache.get_or_render('vehicleType_mpg_plot', params, lambda: _render_vehicle_type_mpg_plot(year))
+    if request.method == 'POST':
+        return 'Plot is loaded into Redis.\n'
+    else:
+        return _png_response(file_bytes, '{}_MPGvType.png'.format(year))
 
 @app.route('/download/<jobid>', methods=['GET'])
 def download(jobid: str) -> bytes:
@@ -344,29 +594,91 @@ def download(jobid: str) -> bytes:
     Returns:
         auto_img (bytes): (if method is GET) bytes object of the image for the data set
     """
-    if rd3.exists('job.'+jobid) and b'image' in rd3.hgetall('job.'+jobid):
-        path = './{jobid}.png'
-        with open(path, 'wb') as f:
-            f.write(rd3.hget('job.'+jobid, b'image'))
-        return send_file(path, mimetype='image/png', as_attachment=True)
+    image = get_job_image(jobid)
+    if image is not None:
+        return _png_response(image, '{}.png'.format(jobid))
     else:
         return 'Please enter a valid job id\n'
 
 @app.route('/status/<jobid>', methods=['GET'])
 def status(jobid: str) -> str:
     """
-    Returns the job status given the job ID
+    Returns the job status given the job ID. With ?wait=<seconds> the request waits, up to
+    MAX_STATUS_WAIT seconds, for the job to complete or fail before answering
 
     Args:
         jobid (str): pseudo-random identifier for a job
     Returns:
         status (if method is GET): the status of the specific job
     """
-    if rd3.exists('job.'+jobid):
-        return 'Status: ' + rd3.hget('job.'+jobid, b'status').decode() + '\n'
+    if 'wait' in request.args:
+        try:
+            wait = float(request.args['wait'])
+            if not math.isfinite(wait):
+                raise ValueError(wait)
+        except ValueError:
+            return 'Invalid wait, please enter a number of seconds\n', 400
+        job_status = job_events.wait_until_finished(jobid, max(0.0, min(wait, MAX_STATUS_WAIT)))
+    else:
+        job_status = get_job_status(jobid)
+    if job_status is not None:
+        return 'Status: ' + job_status + '\n'
     else:
         return 'Please enter a valid job id\n'
 
+def _job_events(jobid: str, job_status: str):
+    """
+    Yields a server-sent event with the status of a job and another one every time it
+    changes, until the job is complete or failed
+
+    Args:
+        jobid (str): pseudo-random identifier for a job
+        job_status (str): the current status of the job
+    Returns:
+        events (str): the events of the stream
+    """
+    sent = None
+    while True:
+        if job_status != sent:
+            yield 'event: status\ndata: {}\n\n'.format(json.dumps({'id': jobid, 'status': job_status}))
+            sent = job_status
+            if job_status is None or job_status in FINAL_STATUSES:
+                return
+        else:
+            yield ': keepalive\n\n'
+        job_status = job_events.wait_for_status(jobid, sent, STATUS_KEEPALIVE)
+
+@app.route('/status/<jobid>/events', methods=['GET'])
+def status_events(jobid: str):
+    """
+    Streams the status of a job as server-sent events, one when the stream opens and one
+    on every change, ending once the job is complete or failed
+
+    Args:
+        jobid (str): pseudo-random identifier for a job
+    Returns:
+        events: the text/event-stream response
+    """
+    job_status = get_job_status(jobid)
+    if job_status is None:
+        return 'Please enter a valid job id\n'
+    return Response(_job_events(jobid, job_status), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Returns the request, redis, plot and job metrics of every API process and worker in the
+    Prometheus text format for the '/metrics' route
+
+    Args:
+        N/A
+    Returns:
+        metrics (str): the metrics in the Prometheus text format
+    """
+    gauges = {'job_queue_depth': len(q), 'job_queue_claimed': q.claimed(), 'job_results_bytes': int(rd3.get(RESULTS_BYTES_KEY) or 0)}
+    return Response(metrics.render(rd3, gauges), mimetype='text/plain; version=0.0.4')
+
 @app.route('/help', methods=['GET'])
 def get_help():
     """
@@ -381,10 +693,18 @@ def get_help():
             /help returns all the routes and their purpose
             /data 
                 -X GET returns the entire data set (hundreds of dictionaries)
+                    ?limit=<n>&cursor=<cursor> returns one page of rows and the cursor of the next page
+                    ?format=ndjson streams the rows as newline delimited JSON
+                    ?stream=true streams the rows as one JSON list
+                    ?year=<years>&start=<year>&end=<year>&manufacturer=<manufacturers>&vehicle_type=<types> only returns the matching rows
+                    ?fields=<columns> only returns the listed columns
+                    ?format=csv|arrow|parquet downloads the rows as CSV, an Arrow IPC stream or Parquet,
+                        also on /years/<year> and the /manufacturers row routes
                 -X POST adds the data to the redis database
                 -X DELETE deletes all the data from the redis database
             /years
                 returns a list of all the years recorded in the dataset
+                    ?start=<year>&end=<year> only returns the numeric years in that range
             /years/<year>
                 returns a list of all the data from the specified year
             /manufacturers
@@ -395,6 +715,9 @@ def get_help():
                 returns a list of the years where there is data for a specific manufacturer
             /manufacturer/<manufacturer>/years/<year>
                 returns a list for the data for the specified manufacturer and year if found in the Auto Trends database route
+            /stats
+                returns aggregate statistics of the numeric columns, use ?group_by=year,manufacturer,vehicle_type
+                ?columns=<columns> and ?aggregates=count,mean,min,max,weighted_mean,harmonic_mean to choose them
             /co2_year_plot
                 -X POST loads a plot of the total co2 emissions for a user specified range of years
                 -X GET <host>/co2_year_plot --output output.png returns a plot of total co2 emissions for a range of years to redis data base
@@ -410,9 +733,16 @@ def get_help():
             /download/<jobid>
                 downloads an image that was generated by the worker from Redis given the job ID
             /jobs
-                API route for creating a new job to do analysis. This route accepts a JSON payload describing the job to be created
+                API route for creating a new job to do analysis. This route accepts a JSON payload describing the job to be created,
+                or a list of them. Submitting a job identical to an existing one returns the existing job.
+                A job may set "priority" to high, normal or low. Returns 503 while the job queue is full
             /status/<jobid>
-                returns the status of the specified job id\n"""
+                returns the status of the specified job id
+                    ?wait=<seconds> waits for the job to complete or fail before answering
+            /status/<jobid>/events
+                streams the status of the specified job id as server-sent events until it completes or fails
+            /metrics
+                returns request latency, redis usage, plot render, queue and job metrics in the Prometheus text format\n"""
     return help_user
 
 if __name__ == '__main__':
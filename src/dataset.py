@@ -0,0 +1,147 @@
+import threading
+import numpy as np
+import artifact
+import datastore
+
+MISSING = artifact.MISSING
+
+class Dataset:
+    """
+    Column oriented, in memory copy of one version of the Auto Trends data set. Every column
+    is kept as an array of the original strings, or as dictionary codes when it is mapped
+    from an artifact that stores it that way, and, when all of its values are numbers or
+    the '-' placeholder, as a float array with NaN where the value is missing.
+    """
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.columns = list(rows[0].keys()) if rows else []
+        self.text = {}
+        self.numeric = {}
+        # dictionary codes and their values for the columns stored that way in an artifact
+        self.codes = {}
+        self.categories = {}
+        for name in self.columns:
+            values = np.array([row.get(name, MISSING) for row in rows], dtype=object)
+            self.text[name] = values
+            missing = values == MISSING
+            try:
+                self.numeric[name] = np.where(missing, 'nan', values).astype(float)
+            except ValueError:
+                pass
+        # Model Year also holds non numeric values like 'Prelim. 2022', which are NaN here
+        if 'Model Year' in self.text:
+            years = self.text['Model Year']
+            digits = np.array([year.isdigit() for year in years], dtype=bool)
+            self.year = np.where(digits, years, 'nan').astype(float)
+        else:
+            self.year = np.empty(0)
+
+    @classmethod
+    def from_artifact(cls, version, data):
+        """
+        Build the data set from a memory mapped artifact. Every column stays mapped, so it is
+        read from the page cache shared by every process, and dictionary columns are only
+        decoded for the rows that are asked for.
+        """
+        dataset = cls(version, [])
+        dataset.columns = list(data.columns)
+        for name in data.columns:
+            if name in data.categories:
+                dataset.codes[name] = data.codes(name)
+                dataset.categories[name] = data.categories[name]
+            else:
+                dataset.text[name] = data.text(name)
+        for name in data.numeric_columns:
+            dataset.numeric[name] = data.values(name)
+        dataset.year = data.year()
+        return dataset
+
+    def __len__(self):
+        return len(self.year)
+
+    def values(self, name):
+        """Return a numeric column as floats, NaN where the value is missing."""
+        return self.numeric[name]
+
+    def strings(self, name, rows):
+        """Return the original strings of a column for the selected rows, decoding its codes if it has them."""
+        if name in self.codes:
+            return self.categories[name][self.codes[name][rows]]
+        return self.text[name][rows]
+
+    def factorize(self, name, rows):
+        """
+        Return the sorted distinct strings of a column among the selected rows and the index
+        of the string of every selected row in them, working on the codes if it has them.
+        """
+        if name not in self.codes:
+            return np.unique(self.text[name][rows], return_inverse=True)
+        found, inverse = np.unique(self.codes[name][rows], return_inverse=True)
+        # the categories are sorted, so the strings come out in the same order
+        return self.categories[name][found], inverse
+
+    def present(self, name):
+        """Return the mask of rows where a numeric column has a value."""
+        return ~np.isnan(self.numeric[name])
+
+    def mask(self, year=None, start=None, end=None, manufacturer=None, vehicle_type=None):
+        """Return the boolean mask of rows matching every filter that is given."""
+        selected = np.ones(len(self), dtype=bool)
+        if not len(self):
+            return selected
+        if year is not None:
+            selected &= self.year == int(year)
+        if start is not None:
+            selected &= self.year >= int(start)
+        if end is not None:
+            selected &= self.year <= int(end)
+        if manufacturer is not None:
+            selected &= self._isin('Manufacturer', [manufacturer])
+        if vehicle_type is not None:
+            selected &= self._isin('Vehicle Type', [vehicle_type])
+        return selected
+
+    def select(self, years=None, start=None, end=None, manufacturers=None, vehicle_types=None):
+        """
+        Return the boolean mask of rows matching every filter that is given, with the
+        arguments of datastore.select_keys: lists of Model Years, Manufacturers and Vehicle
+        Types, and a numeric Model Year range.
+        """
+        selected = self.mask(start=start, end=end)
+        if not len(self):
+            return selected
+        for name, values in (('Model Year', years), ('Manufacturer', manufacturers), ('Vehicle Type', vehicle_types)):
+            if values is not None:
+                selected &= self._isin(name, values)
+        return selected
+
+    def _isin(self, name, values):
+        """Return the mask of rows where a text column is one of `values`, comparing codes if it has them."""
+        if name not in self.codes:
+            return np.isin(self.text[name], list(values))
+        found = np.flatnonzero(np.isin(self.categories[name], list(values)))
+        return np.isin(self.codes[name], found)
+
+_current = None
+_lock = threading.Lock()
+
+def get_dataset():
+    """
+    Return the in memory data set, rebuilding it only when the data set version has changed
+    since it was last built. It is mapped from the local artifact when redis holds the data
+    of the same file, and read from redis otherwise.
+    """
+    global _current
+    current = _current
+    if current is not None and current.version == datastore.version():
+        return current
+    with _lock:
+        data_version, source = datastore.source_info()
+        if _current is None or _current.version != data_version:
+            data = artifact.open_artifact()
+            if data is not None and source is not None and data.source == source:
+                _current = Dataset.from_artifact(data_version, data)
+            else:
+                _current = Dataset(*datastore.versioned_rows())
+        return _current
@@ -0,0 +1,440 @@
+import base64
+import csv
+import hashlib
+import json
+import os
+import time
+import uuid
+import zlib
+from jobs import rd, rd3, rd_staging, STAGING_DB
+
+LOAD_BATCH_SIZE = int(os.environ.get('LOAD_BATCH_SIZE', '1000'))
+LOAD_LOCK_KEY = 'lock:data_load'
+SCAN_BATCH_SIZE = int(os.environ.get('SCAN_BATCH_SIZE', '500'))
+
+# 'hash' stores every row as its own hash; 'compact' packs each row as a JSON list of its
+# values into one of ROW_BUCKETS hashes and stores the column names once under SCHEMA_KEY.
+# Only loads follow DATA_LAYOUT, reads find the layout of the loaded data from SCHEMA_KEY
+DATA_LAYOUT = os.environ.get('DATA_LAYOUT', 'hash')
+ROW_BUCKETS = int(os.environ.get('ROW_BUCKETS', '64'))
+
+VERSION_KEY = 'meta:version'
+UPDATED_AT_KEY = 'meta:updated_at'
+SOURCE_KEY = 'meta:source'
+SCHEMA_KEY = 'meta:schema'
+COLUMNS_KEY = 'meta:columns'
+ROWS_KEY = 'idx:rows'
+YEARS_KEY = 'idx:years'
+# sorted sets scored by numeric Model Year, of the years and of the row keys, for range
+# queries; years like 'Prelim. 2022' are left out of both
+YEAR_SCORES_KEY = 'idx:year_scores'
+ROWS_BY_YEAR_KEY = 'idx:rows_by_year'
+MANUFACTURERS_KEY = 'idx:manufacturers'
+VEHICLE_TYPES_KEY = 'idx:vehicle_types'
+
+def _year_key(year):
+    """Generate the redis key of the set holding every row key for a Model Year."""
+    return 'idx:year:{}'.format(year)
+
+def _manufacturer_key(manufacturer):
+    """Generate the redis key of the set holding every row key for a Manufacturer."""
+    return 'idx:manufacturer:{}'.format(manufacturer)
+
+def _manufacturer_years_key(manufacturer):
+    """Generate the redis key of the set holding the Model Years seen for a Manufacturer."""
+    return 'idx:manufacturer_years:{}'.format(manufacturer)
+
+def _vehicle_type_key(vehicle_type):
+    """Generate the redis key of the set holding every row key for a Vehicle Type."""
+    return 'idx:vehicle_type:{}'.format(vehicle_type)
+
+def _bucket_key(key, buckets):
+    """Generate the redis key of the hash that holds a packed row in the compact layout."""
+    return 'rows:{}'.format(zlib.crc32(key.encode()) % buckets)
+
+def row_key(item):
+    """Generate the redis key of a dataset row from its Manufacturer, Model Year and Vehicle Type."""
+    return item['Manufacturer'] + '-' + item['Model Year'] + '-' + item['Vehicle Type']
+
+def index_row(client, key, item):
+    """
+    Add a row to the lookup indexes. `client` may be the redis connection or a pipeline
+    so the index writes can be batched with the row itself.
+    """
+    year = item['Model Year']
+    manufacturer = item['Manufacturer']
+    vehicle_type = item['Vehicle Type']
+    client.sadd(ROWS_KEY, key)
+    client.sadd(YEARS_KEY, year)
+    client.sadd(MANUFACTURERS_KEY, manufacturer)
+    client.sadd(VEHICLE_TYPES_KEY, vehicle_type)
+    client.sadd(_year_key(year), key)
+    client.sadd(_manufacturer_key(manufacturer), key)
+    client.sadd(_manufacturer_years_key(manufacturer), year)
+    client.sadd(_vehicle_type_key(vehicle_type), key)
+    if year.isdigit():
+        client.zadd(YEAR_SCORES_KEY, {year: int(year)})
+        client.zadd(ROWS_BY_YEAR_KEY, {key: int(year)})
+
+def _store_row(client, key, item, columns):
+    """Write one row in the layout chosen by DATA_LAYOUT."""
+    if DATA_LAYOUT == 'compact':
+        packed = json.dumps([item[name] for name in columns], separators=(',', ':'))
+        client.hset(_bucket_key(key, ROW_BUCKETS), key, packed)
+    else:
+        client.hset(key, mapping=item)
+
+def file_checksum(path):
+    """Return the SHA-1 of a data file, which identifies the data set it holds."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_csv(path, batch_size=LOAD_BATCH_SIZE):
+    """
+    Load the CSV at `path` with load_rows. Returns the number of rows loaded and the
+    elapsed time in seconds, or None if another load is already in progress.
+    """
+    source = file_checksum(path)
+    with open(path, 'r') as f:
+        reader = csv.DictReader(f)
+        return load_rows(reader.fieldnames, reader, source, batch_size)
+
+def load_rows(columns, items, source, batch_size=LOAD_BATCH_SIZE):
+    """
+    Stream `items`, dicts keyed by `columns`, into the staging keyspace in pipelined batches
+    and then swap it with the live keyspace in one atomic SWAPDB, so readers never see a
+    partial load. `source` is the checksum of the file the rows were read from.
+
+    Returns the number of rows loaded and the elapsed time in seconds, or None if another
+    load is already in progress.
+    """
+    lock = rd3.lock(LOAD_LOCK_KEY, timeout=600)
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        start = time.perf_counter()
+        rd_staging.flushdb()
+        count = 0
+        pipe = rd_staging.pipeline(transaction=False)
+        for item in items:
+            key = row_key(item)
+            _store_row(pipe, key, item, columns)
+            index_row(pipe, key, item)
+            count += 1
+            if count % batch_size == 0:
+                pipe.execute()
+        if columns:
+            pipe.set(COLUMNS_KEY, json.dumps(columns))
+        if DATA_LAYOUT == 'compact' and columns:
+            pipe.set(SCHEMA_KEY, json.dumps({'columns': columns, 'buckets': ROW_BUCKETS}))
+        # lets processes with a built artifact of the same file read it instead of redis
+        pipe.set(SOURCE_KEY, source)
+        pipe.execute()
+        rd.transaction(_swap_staging, VERSION_KEY)
+        # the staging db now holds the previous data set
+        rd_staging.flushdb(asynchronous=True)
+        return count, time.perf_counter() - start
+    finally:
+        lock.release()
+
+def _swap_staging(pipe):
+    """Swap the staging db in and bump the data set version in the same transaction."""
+    rd_staging.set(VERSION_KEY, pipe.get(VERSION_KEY) or 0)
+    pipe.multi()
+    pipe.swapdb(0, STAGING_DB)
+    pipe.incr(VERSION_KEY)
+    pipe.set(UPDATED_AT_KEY, time.time())
+
+def _flush(pipe):
+    """Delete the data set and bump the data set version in the same transaction."""
+    version = int(pipe.get(VERSION_KEY) or 0)
+    pipe.multi()
+    pipe.flushdb()
+    pipe.set(VERSION_KEY, version + 1)
+    pipe.set(UPDATED_AT_KEY, time.time())
+
+def clear():
+    """Delete the data set from redis."""
+    rd.transaction(_flush, VERSION_KEY)
+
+def version():
+    """
+    Return the data set version. It changes every time the data set is loaded or deleted,
+    so anything derived from the data can be cached against it.
+    """
+    return int(rd.get(VERSION_KEY) or 0)
+
+def version_info():
+    """
+    Return the data set version and the unix time it was loaded or deleted, None if that
+    is not known, with one round trip.
+    """
+    pipe = rd.pipeline(transaction=False)
+    pipe.get(VERSION_KEY)
+    pipe.get(UPDATED_AT_KEY)
+    current, updated_at = pipe.execute()
+    return int(current or 0), float(updated_at) if updated_at is not None else None
+
+def source_info():
+    """
+    Return the data set version and the checksum of the file it was loaded from, None if
+    it is not loaded, with one round trip.
+    """
+    pipe = rd.pipeline(transaction=False)
+    pipe.get(VERSION_KEY)
+    pipe.get(SOURCE_KEY)
+    current, source = pipe.execute()
+    return int(current or 0), source
+
+def _check_fields(fields, stored_columns):
+    """Raise ValueError if a field is not one of the stored column names, if they are known."""
+    if fields and stored_columns:
+        unknown = [name for name in fields if name not in json.loads(stored_columns)]
+        if unknown:
+            raise ValueError('unknown fields {}'.format(', '.join(unknown)))
+
+def check_fields(fields):
+    """Raise ValueError if any of `fields` is not a column of the data set."""
+    _check_fields(fields, rd.get(COLUMNS_KEY))
+
+# schema of the loaded data as last seen by this process, None for the hash layout
+_schema = None
+
+def _fetch(keys, atomic=False, fields=None):
+    """
+    Fetch the rows for `keys`, in key order, with one pipelined round trip whatever layout
+    they are stored in, and return the data set version read in the same round trip with
+    them. With `atomic` the reads run in one MULTI so they all see the same data set. With
+    `fields` only those columns are read and returned, and ValueError is raised if one of
+    them is not a column of the data set.
+    """
+    global _schema
+    keys = sorted(keys)
+    while True:
+        schema = _schema
+        pipe = rd.pipeline(transaction=atomic)
+        pipe.get(SCHEMA_KEY)
+        pipe.get(COLUMNS_KEY)
+        if schema is None:
+            for key in keys:
+                if fields:
+                    pipe.hmget(key, fields)
+                else:
+                    pipe.hgetall(key)
+        else:
+            buckets = {}
+            for key in keys:
+                buckets.setdefault(_bucket_key(key, schema['buckets']), []).append(key)
+            for bucket, bucket_keys in buckets.items():
+                pipe.hmget(bucket, bucket_keys)
+        pipe.get(VERSION_KEY)
+        stored, columns, *results, current = pipe.execute()
+        stored = json.loads(stored) if stored else None
+        if stored != schema:
+            # the data was loaded in another layout or with another schema, read again
+            _schema = stored
+            continue
+        _check_fields(fields, columns)
+        if schema is None:
+            if fields:
+                # every row has every column, so a row with no values does not exist
+                results = [dict(zip(fields, values)) if any(value is not None for value in values) else None
+                           for values in results]
+            return current, [row for row in results if row]
+        packed = {}
+        for bucket_keys, values in zip(buckets.values(), results):
+            packed.update(zip(bucket_keys, values))
+        columns = schema['columns']
+        positions = [columns.index(name) for name in fields] if fields else range(len(columns))
+        names = fields or columns
+        rows = []
+        for key in keys:
+            if packed[key] is not None:
+                values = json.loads(packed[key])
+                rows.append({name: values[i] for name, i in zip(names, positions)})
+        return current, rows
+
+def versioned_rows():
+    """Return the data set version together with every row of that version."""
+    while True:
+        pipe = rd.pipeline()
+        pipe.get(VERSION_KEY)
+        pipe.smembers(ROWS_KEY)
+        current, keys = pipe.execute()
+        after, rows = _fetch(keys, atomic=True)
+        # a load or delete landed between the two round trips, read again
+        if after == current:
+            return int(current or 0), rows
+
+def is_loaded():
+    """Return True if the Auto Trends data set is loaded in redis."""
+    return rd.exists(ROWS_KEY) == 1
+
+def fetch_rows(keys, fields=None):
+    """
+    Fetch the rows for the given keys with a single pipelined round trip, only the `fields`
+    columns of them if given. Raises ValueError for an unknown field.
+    """
+    return _fetch(keys, fields=fields)[1]
+
+def all_rows(fields=None):
+    """Return every row in the data set, only the `fields` columns of them if given."""
+    return fetch_rows(rd.smembers(ROWS_KEY), fields)
+
+def years():
+    """Return the distinct Model Years in the data set."""
+    return sorted(rd.smembers(YEARS_KEY))
+
+def manufacturers():
+    """Return the distinct Manufacturers in the data set."""
+    return sorted(rd.smembers(MANUFACTURERS_KEY))
+
+def manufacturer_years(manufacturer):
+    """Return the distinct Model Years with data for a Manufacturer."""
+    return sorted(rd.smembers(_manufacturer_years_key(manufacturer)))
+
+def rows_for_year(year):
+    """Return every row for a Model Year."""
+    return fetch_rows(rd.smembers(_year_key(year)))
+
+def rows_for_manufacturer(manufacturer):
+    """Return every row for a Manufacturer."""
+    return fetch_rows(rd.smembers(_manufacturer_key(manufacturer)))
+
+def _score_range(start, end):
+    """Return the ZRANGEBYSCORE bounds for the years from `start` to `end`, either may be None."""
+    return '-inf' if start is None else start, '+inf' if end is None else end
+
+def years_between(start=None, end=None):
+    """Return the numeric Model Years from `start` to `end`, either of which may be None."""
+    return rd.zrangebyscore(YEAR_SCORES_KEY, *_score_range(start, end))
+
+def select_keys(years=None, start=None, end=None, manufacturers=None, vehicle_types=None):
+    """
+    Return the keys of the rows matching every filter that is given: any of the Model
+    `years`, a numeric Model Year from `start` to `end`, any of the `manufacturers` and any
+    of the `vehicle_types`. The sets are combined inside redis from the indexes, so only
+    the matching keys are transferred. Every row is selected when no filter is given.
+    """
+    in_range = start is not None or end is not None
+    groups = []
+    if years is not None:
+        groups.append([_year_key(year) for year in years])
+    if manufacturers is not None:
+        groups.append([_manufacturer_key(manufacturer) for manufacturer in manufacturers])
+    if vehicle_types is not None:
+        groups.append([_vehicle_type_key(vehicle_type) for vehicle_type in vehicle_types])
+    if not groups:
+        if in_range:
+            return set(rd.zrangebyscore(ROWS_BY_YEAR_KEY, *_score_range(start, end)))
+        return rd.smembers(ROWS_KEY)
+    if not all(groups):
+        return set()
+    # each filter with several values is first unioned into a temporary set, and a year range
+    # is copied out of the sorted set, in the same transaction as the intersection that reads
+    # them and the delete that removes them
+    pipe = rd.pipeline(transaction=True)
+    operands = []
+    temporary = []
+    for group in groups:
+        if len(group) == 1:
+            operands.append(group[0])
+        else:
+            key = 'tmp:select:{}'.format(uuid.uuid4().hex)
+            pipe.sunionstore(key, group)
+            operands.append(key)
+            temporary.append(key)
+    if in_range:
+        key = 'tmp:select:{}'.format(uuid.uuid4().hex)
+        pipe.zrangestore(key, ROWS_BY_YEAR_KEY, *_score_range(start, end), byscore=True)
+        operands.append(key)
+        temporary.append(key)
+        # ZINTER takes plain sets as well as sorted sets
+        pipe.zinter(operands)
+    else:
+        pipe.sinter(operands)
+    if temporary:
+        pipe.delete(*temporary)
+        return set(pipe.execute()[-2])
+    return pipe.execute()[-1]
+
+def rows_for_manufacturer_year(manufacturer, year):
+    """Return the rows for a Manufacturer in a Model Year."""
+    return fetch_rows(rd.sinter(_manufacturer_key(manufacturer), _year_key(year)))
+
+def iter_rows(batch_size=SCAN_BATCH_SIZE, keys=None, fields=None):
+    """
+    Yield every row of the data set, walking the row index with SSCAN and fetching each
+    batch with one pipelined round trip, so the whole data set is never held in memory.
+    With `keys` only those rows are yielded, in key order, and with `fields` only those
+    columns of them.
+    """
+    if keys is not None:
+        keys = sorted(keys)
+        for i in range(0, len(keys), batch_size):
+            yield from fetch_rows(keys[i:i + batch_size], fields)
+        return
+    seen = set()
+    cursor = 0
+    while True:
+        cursor, keys = rd.sscan(ROWS_KEY, cursor, count=batch_size)
+        # SSCAN may return a key more than once
+        keys = [key for key in keys if key not in seen]
+        seen.update(keys)
+        yield from fetch_rows(keys, fields)
+        if cursor == 0:
+            return
+
+def _encode_cursor(data_version, scan_cursor, offset):
+    """Pack a page position into an opaque cursor string."""
+    raw = json.dumps([data_version, scan_cursor, offset]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def _decode_cursor(cursor):
+    """Unpack a cursor string made by `_encode_cursor`, raising ValueError if it is malformed."""
+    try:
+        data_version, scan_cursor, offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(data_version), int(scan_cursor), int(offset)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError('malformed cursor') from e
+
+def page_rows(cursor=None, limit=SCAN_BATCH_SIZE, keys=None, fields=None):
+    """
+    Return one page of at most `limit` rows and the cursor of the next page, which is None
+    after the last page. With `keys` the pages walk only those rows, in key order, and with
+    `fields` only those columns are returned. Raises ValueError if the cursor is malformed
+    or was issued for another version of the data set.
+    """
+    current = version()
+    if cursor:
+        data_version, scan_cursor, offset = _decode_cursor(cursor)
+        if data_version != current:
+            raise ValueError('cursor is from an older version of the data set')
+    else:
+        scan_cursor, offset = 0, 0
+    if keys is not None:
+        keys = sorted(keys)
+        end = offset + limit
+        next_cursor = _encode_cursor(current, 0, end) if end < len(keys) else None
+        return fetch_rows(keys[offset:end], fields), next_cursor
+    keys = []
+    while True:
+        next_scan, batch = rd.sscan(ROWS_KEY, scan_cursor, count=limit)
+        # the same cursor always returns the same batch while the set is unchanged
+        batch = batch[offset:]
+        taken = batch[:limit - len(keys)]
+        keys.extend(taken)
+        if len(taken) < len(batch):
+            next_cursor = _encode_cursor(current, scan_cursor, offset + len(taken))
+            break
+        if next_scan == 0:
+            next_cursor = None
+            break
+        scan_cursor, offset = next_scan, 0
+        if len(keys) == limit:
+            next_cursor = _encode_cursor(current, scan_cursor, 0)
+            break
+    return fetch_rows(keys, fields), next_cursor
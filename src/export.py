@@ -0,0 +1,160 @@
+import csv
+import io
+import os
+import numpy as np
+import artifact
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# rows per CSV chunk, Arrow record batch and Parquet row group
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '10000'))
+
+# format: (media type, file extension)
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+def negotiate(format_arg, accept):
+    """
+    Return the export format asked for by the `format` query parameter, or else by the
+    Accept header, or None for the default JSON.
+    """
+    if format_arg in FORMATS:
+        return format_arg
+    if format_arg is None:
+        for name, (mimetype, _) in FORMATS.items():
+            # only an explicit mention counts, */* still means JSON
+            if accept.quality(mimetype) and mimetype in accept.values():
+                return name
+    return None
+
+def available(name):
+    """Return True if the optional packages needed by an export format are installed."""
+    return name == 'csv' or pyarrow is not None
+
+class _Sink(io.RawIOBase):
+    """Write only file that keeps what was written until it is drained."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        """Return and forget everything written since the last drain."""
+        data, self._chunks = b''.join(self._chunks), []
+        return data
+
+def _batches(rows):
+    """Split the selected row indexes into EXPORT_BATCH_SIZE slices."""
+    for start in range(0, len(rows), EXPORT_BATCH_SIZE):
+        yield rows[start:start + EXPORT_BATCH_SIZE]
+
+def _csv(data, rows, fields):
+    """Yield the selected rows as CSV with a header line, in the original text of every value."""
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(fields)
+    for batch in _batches(rows):
+        writer.writerows(zip(*[data.strings(name, batch).tolist() for name in fields]))
+        yield out.getvalue().encode('utf-8')
+        out.seek(0)
+        out.truncate()
+    if out.tell():
+        yield out.getvalue().encode('utf-8')
+
+def _columns(data, rows, fields):
+    """
+    Return how to build every column in Arrow: numeric columns as floats with nulls where the
+    value is missing, low cardinality columns dictionary encoded once for the whole export so
+    every batch shares one dictionary, and the others as strings.
+    """
+    columns = []
+    for name in fields:
+        # checked first so Model Year has the same type whether or not every year is a number
+        if name in data.codes or name in artifact.DICTIONARY_COLUMNS:
+            if name in data.codes:
+                categories, codes = data.categories[name], data.codes[name][rows]
+            else:
+                categories, codes = data.factorize(name, rows)
+            dictionary = pyarrow.array(list(categories), pyarrow.string())
+            columns.append((pyarrow.dictionary(pyarrow.int32(), pyarrow.string()), name,
+                            (dictionary, np.asarray(codes, dtype=np.int32).ravel())))
+        elif name in data.numeric:
+            columns.append((pyarrow.float64(), name, None))
+        else:
+            columns.append((pyarrow.string(), name, None))
+    return columns
+
+def _record_batches(data, rows, fields):
+    """Return the Arrow schema of the export and a generator of its record batches."""
+    columns = _columns(data, rows, fields)
+    schema = pyarrow.schema([(name, kind) for kind, name, _ in columns])
+    def generate():
+        for offset in range(0, len(rows), EXPORT_BATCH_SIZE):
+            batch = rows[offset:offset + EXPORT_BATCH_SIZE]
+            arrays = []
+            for kind, name, encoded in columns:
+                if encoded is not None:
+                    dictionary, codes = encoded
+                    arrays.append(pyarrow.DictionaryArray.from_arrays(
+                        codes[offset:offset + EXPORT_BATCH_SIZE], dictionary))
+                elif name in data.numeric:
+                    values = np.asarray(data.numeric[name][batch])
+                    arrays.append(pyarrow.array(values, pyarrow.float64(), mask=np.isnan(values)))
+                else:
+                    arrays.append(pyarrow.array(data.strings(name, batch).tolist(), pyarrow.string()))
+            yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+    return schema, generate()
+
+def _arrow(data, rows, fields):
+    """Yield the selected rows as an Arrow IPC stream, one record batch at a time."""
+    schema, batches = _record_batches(data, rows, fields)
+    sink = _Sink()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
+
+def _parquet(data, rows, fields):
+    """Yield the selected rows as a Parquet file, one row group at a time."""
+    schema, batches = _record_batches(data, rows, fields)
+    sink = _Sink()
+    with pyarrow.parquet.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
+
+def stream(name, data, selected, fields=None):
+    """
+    Return a generator of the bytes of the rows of `data` where `selected` is True in
+    export format `name`, only the `fields` columns of them if given. Raises ValueError for
+    an unknown field before anything is generated.
+    """
+    fields = fields or data.columns
+    unknown = [field for field in fields if field not in data.columns]
+    if unknown and data.columns:
+        raise ValueError('unknown fields {}'.format(', '.join(unknown)))
+    if not data.columns:
+        fields = []
+    rows = np.flatnonzero(selected)
+    return {'csv': _csv, 'arrow': _arrow, 'parquet': _parquet}[name](data, rows, fields)
@@ -0,0 +1,18 @@
+import os
+
+# Production settings for serving auto_trends_api:app with gunicorn, e.g.
+#   gunicorn --config gunicorn.conf.py auto_trends_api:app
+bind = '0.0.0.0:' + os.environ.get('PORT', '5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', '2'))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
+# import the app once in the master so workers fork with it already loaded
+preload_app = True
+
+def post_fork(server, worker):
+    """Give every forked worker its own redis connections."""
+    import jobs
+    jobs.reset_connections()
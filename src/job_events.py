@@ -0,0 +1,108 @@
+import threading
+import time
+import redis
+import jobs
+
+class JobWatcher:
+    """
+    Wakes the threads of this process that wait on jobs when the status of a job changes.
+    The process holds a single pattern subscription to every job status channel, read by
+    one background thread, so any number of waiting clients costs no extra connection and
+    no polling.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # job id -> number of threads waiting on it, and the last status published for it
+        self._waiters = {}
+        self._latest = {}
+        self._thread = None
+        self._subscribed = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        """Start the listener thread in this process, if it is not running yet."""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._subscribed.clear()
+                self._thread = threading.Thread(target=self._listen, name='job-watcher', daemon=True)
+                self._thread.start()
+        self._subscribed.wait(timeout=5)
+
+    def _listen(self):
+        """Read status changes forever, reconnecting after redis errors."""
+        pattern = jobs.job_status_channel('*')
+        while True:
+            pubsub = jobs.rd3.pubsub()
+            try:
+                pubsub.psubscribe(pattern)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    if message['type'] == 'psubscribe':
+                        self._subscribed.set()
+                    elif message['type'] == 'pmessage':
+                        self._notify(message['channel'].decode('utf-8'), message['data'].decode('utf-8'))
+            except redis.RedisError:
+                # waiters fall back to reading the status when their wait times out
+                self._subscribed.clear()
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+    def _notify(self, channel, status):
+        """Record a status change and wake the waiting threads."""
+        jid = channel.split('.', 1)[1]
+        with self._cond:
+            if jid in self._waiters:
+                self._latest[jid] = status
+                self._cond.notify_all()
+
+    def wait(self, jid, known=None, timeout=30):
+        """
+        Return the status of a job as soon as it differs from `known` or the job has
+        finished, waiting at most `timeout` seconds. Returns None if there is no such job.
+        """
+        self._start()
+        with self._cond:
+            self._waiters[jid] = self._waiters.get(jid, 0) + 1
+        try:
+            # the job is watched before its status is read, so no change can slip in between
+            status = jobs.get_job_status(jid)
+            if status is None or status != known or status in jobs.FINAL_STATUSES:
+                return status
+            with self._cond:
+                changed = self._cond.wait_for(lambda: self._latest.get(jid, status) != status, timeout)
+                if changed:
+                    return self._latest[jid]
+            return jobs.get_job_status(jid)
+        finally:
+            with self._cond:
+                self._waiters[jid] -= 1
+                if not self._waiters[jid]:
+                    del self._waiters[jid]
+                    self._latest.pop(jid, None)
+
+_watcher = JobWatcher()
+
+def wait_for_status(jid, known=None, timeout=30):
+    """
+    Return the status of a job once it differs from `known` or the job has finished, or
+    after `timeout` seconds. Returns None if there is no such job.
+    """
+    return _watcher.wait(jid, known, timeout)
+
+def wait_until_finished(jid, timeout):
+    """
+    Return the status of a job once it is complete or failed, or its current status after
+    `timeout` seconds. Returns None if there is no such job.
+    """
+    deadline = time.monotonic() + timeout
+    status = jobs.get_job_status(jid)
+    while status is not None and status not in jobs.FINAL_STATUSES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        status = wait_for_status(jid, status, remaining)
+    return status
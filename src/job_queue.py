@@ -0,0 +1,204 @@
+import os
+import time
+import redis
+
+# lanes a job can be queued in, served strictly in this order
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+# seconds a claimed job stays hidden from other workers without a heartbeat
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get('JOB_VISIBILITY_TIMEOUT', '60'))
+
+# Wake up tokens are kept no more numerous than the pending jobs, so an idle worker is never
+# woken for a job that is not there.
+_TRIM_WAKEUPS = """
+local pending = redis.call('ZCARD', {pending})
+if pending == 0 then
+    redis.call('DEL', {wakeup})
+else
+    redis.call('LTRIM', {wakeup}, 0, pending - 1)
+end
+"""
+
+# Queue a job and add a wake up token for it.
+# KEYS: pending, scores, wakeup  ARGV: jid, score
+_PUT_SCRIPT = """
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[1], 'NX', ARGV[2], ARGV[1])
+redis.call('LPUSH', KEYS[3], 1)
+""" + _TRIM_WAKEUPS.format(pending='KEYS[1]', wakeup='KEYS[3]')
+
+# Move the jobs whose visibility timeout has passed back to the pending queue, then move the
+# first pending job to the claimed jobs with a new deadline and count the delivery.
+# KEYS: pending, claimed, attempts, scores, wakeup  ARGV: now, deadline
+_CLAIM_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, jid in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], jid)
+    redis.call('ZADD', KEYS[1], redis.call('HGET', KEYS[4], jid) or 0, jid)
+end
+local popped = redis.call('ZPOPMIN', KEYS[1])
+""" + _TRIM_WAKEUPS.format(pending='KEYS[1]', wakeup='KEYS[5]') + """
+if #popped == 0 then
+    return false
+end
+redis.call('ZADD', KEYS[2], ARGV[2], popped[1])
+return {popped[1], redis.call('HINCRBY', KEYS[3], popped[1], 1)}
+"""
+
+# A claim is owned by the worker that got the current delivery of the job, so a worker whose
+# claim expired and was delivered again cannot acknowledge or retry the job of another.
+# KEYS: claimed, attempts  ARGV: jid, attempt
+_OWNED = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] or not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+"""
+
+# Forget a claimed job.
+# KEYS: claimed, attempts, scores  ARGV: jid, attempt
+_ACK_SCRIPT = _OWNED + """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+return 1
+"""
+
+# Put a claimed job back in the pending queue with its score and a wake up token.
+# KEYS: claimed, attempts, scores, pending, wakeup  ARGV: jid, attempt
+_RETRY_SCRIPT = _OWNED + """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[4], redis.call('HGET', KEYS[3], ARGV[1]) or 0, ARGV[1])
+redis.call('LPUSH', KEYS[5], 1)
+""" + _TRIM_WAKEUPS.format(pending='KEYS[4]', wakeup='KEYS[5]') + """
+return 1
+"""
+
+# Move a job that is still pending to a new score, unless its score changed since it was read.
+# KEYS: pending, scores  ARGV: jid, score read, new score
+_PROMOTE_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] or not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[1], 'XX', ARGV[3], ARGV[1])
+return 1
+"""
+
+# Push back the deadline of the claims that are still owned.
+# KEYS: claimed, attempts  ARGV: deadline, then a job id and its attempt for every claim
+_HEARTBEAT_SCRIPT = """
+local extended = 0
+for i = 2, #ARGV, 2 do
+    if redis.call('HGET', KEYS[2], ARGV[i]) == ARGV[i + 1] and redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+        extended = extended + 1
+    end
+end
+return extended
+"""
+
+class JobQueue:
+    """
+    At least once job queue with priority lanes. A claimed job stays in redis, hidden from
+    other workers until its visibility timeout, which heartbeats extend, and is delivered
+    again if its worker dies before acknowledging it. Every delivery is counted so the
+    worker can give up on a job after a number of attempts.
+    """
+
+    def __init__(self, name, connection_pool=None, visibility_timeout=JOB_VISIBILITY_TIMEOUT):
+        self.redis = redis.StrictRedis(connection_pool=connection_pool)
+        self.visibility_timeout = visibility_timeout
+        # pending job ids scored by lane then submission time, claimed ids scored by deadline
+        self._pending = '{}:pending'.format(name)
+        self._claimed = '{}:claimed'.format(name)
+        self._attempts = '{}:attempts'.format(name)
+        self._scores = '{}:scores'.format(name)
+        self._wakeup = '{}:wakeup'.format(name)
+        self._put = self.redis.register_script(_PUT_SCRIPT)
+        self._claim = self.redis.register_script(_CLAIM_SCRIPT)
+        self._ack = self.redis.register_script(_ACK_SCRIPT)
+        self._retry = self.redis.register_script(_RETRY_SCRIPT)
+        self._heartbeat = self.redis.register_script(_HEARTBEAT_SCRIPT)
+        self._promote = self.redis.register_script(_PROMOTE_SCRIPT)
+
+    def __len__(self):
+        """Return the number of jobs waiting to be claimed."""
+        return self.redis.zcard(self._pending)
+
+    def claimed(self):
+        """Return the number of jobs claimed by workers and not acknowledged yet."""
+        return self.redis.zcard(self._claimed)
+
+    def holds(self, jid):
+        """Return True if the job is waiting to be claimed or claimed and not acknowledged yet."""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zscore(self._pending, jid)
+        pipe.zscore(self._claimed, jid)
+        return any(score is not None for score in pipe.execute())
+
+    def put(self, jid, priority='normal'):
+        """Queue a job in the lane of `priority`, behind the jobs already in that lane."""
+        score = PRIORITIES[priority] * 10 ** 13 + int(time.time() * 1000)
+        self._put(keys=[self._pending, self._scores, self._wakeup], args=[jid, score])
+
+    def promote(self, jid, priority):
+        """
+        Move a job that waits to be claimed up to the lane of `priority`, keeping its place
+        by submission time. Returns True if it moved, False if it was claimed meanwhile or
+        its lane is served before `priority` already.
+        """
+        score = self.redis.hget(self._scores, jid)
+        if score is None:
+            return False
+        submitted = int(score) % 10 ** 13
+        if PRIORITIES[priority] * 10 ** 13 + submitted >= int(score):
+            return False
+        return bool(self._promote(keys=[self._pending, self._scores],
+                                  args=[jid, score, PRIORITIES[priority] * 10 ** 13 + submitted]))
+
+    def claim(self, timeout=1):
+        """
+        Claim the next job, waiting up to `timeout` seconds for one to be queued. Returns
+        the job id and the number of times it has been delivered, or None. The delivery
+        number identifies the claim when the job is acknowledged, retried or kept alive.
+        """
+        claimed = self._try_claim()
+        if claimed is None and timeout:
+            self.redis.blpop(self._wakeup, timeout=timeout)
+            claimed = self._try_claim()
+        return claimed
+
+    def _try_claim(self):
+        """Claim the next job if one is pending."""
+        now = time.time()
+        claimed = self._claim(keys=[self._pending, self._claimed, self._attempts, self._scores, self._wakeup],
+                              args=[now, now + self.visibility_timeout])
+        if not claimed:
+            return None
+        jid, attempts = claimed
+        return jid.decode('utf-8'), int(attempts)
+
+    def heartbeat(self, claims):
+        """
+        Push back the visibility timeout of jobs that are still being worked on, given as a
+        dict of job id to delivery number. Claims delivered again meanwhile are left alone.
+        """
+        if claims:
+            args = [time.time() + self.visibility_timeout]
+            for jid, attempt in claims.items():
+                args.extend([jid, attempt])
+            self._heartbeat(keys=[self._claimed, self._attempts], args=args)
+
+    def ack(self, jid, attempt):
+        """
+        Forget a claimed job once it is done, whether it succeeded or failed for good.
+        Returns False if the claim was lost because the job was delivered again.
+        """
+        return bool(self._ack(keys=[self._claimed, self._attempts, self._scores], args=[jid, attempt]))
+
+    def retry(self, jid, attempt):
+        """
+        Put a claimed job back in front of its lane to be delivered again. Returns False if
+        the claim was lost because the job was delivered again.
+        """
+        return bool(self._retry(keys=[self._claimed, self._attempts, self._scores, self._pending, self._wakeup],
+                                args=[jid, attempt]))
@@ -1,15 +1,94 @@
 import uuid
-from hotqueue import HotQueue
+import time
+import json
+import hashlib
 import redis
 import os
+import metrics
+from job_queue import JobQueue, PRIORITIES
 
 redis_ip = os.environ.get('REDIS_IP', '172.17.0.1')
 if not redis_ip:
     raise Exception()
-rd = redis.StrictRedis(host = redis_ip, port = 6379, db = 0, decode_responses = True)
-rd2 = redis.StrictRedis(host = redis_ip, port = 6379, db = 1)
-rd3 = redis.StrictRedis(host = redis_ip, port = 6379, db = 3)
-q = HotQueue("queue", host = redis_ip, port = 6379, db = 2)
+redis_port = int(os.environ.get('REDIS_PORT', '6379'))
+
+# every client shares a bounded pool per db; a thread that finds the pool exhausted waits up
+# to REDIS_POOL_TIMEOUT seconds for a free connection instead of opening yet another one
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', '32'))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', '5'))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', '10'))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', '2'))
+_pools = []
+
+def _pool(db, decode_responses = False):
+    """Create the connection pool for one redis db."""
+    pool = redis.BlockingConnectionPool(host = redis_ip, port = redis_port, db = db,
+                                        decode_responses = decode_responses,
+                                        max_connections = REDIS_MAX_CONNECTIONS,
+                                        timeout = REDIS_POOL_TIMEOUT,
+                                        socket_timeout = REDIS_SOCKET_TIMEOUT,
+                                        socket_connect_timeout = REDIS_CONNECT_TIMEOUT,
+                                        socket_keepalive = True,
+                                        health_check_interval = 30,
+                                        connection_class = metrics.InstrumentedConnection)
+    _pools.append(pool)
+    return pool
+
+def reset_connections():
+    """
+    Drop every pooled connection. Called in each server worker after it is forked so no
+    socket opened by the parent process is ever shared.
+    """
+    for pool in _pools:
+        pool.reset()
+
+rd = redis.StrictRedis(connection_pool = _pool(0, decode_responses = True))
+rd2 = redis.StrictRedis(connection_pool = _pool(1))
+rd3 = redis.StrictRedis(connection_pool = _pool(3))
+# staging keyspace that POST /data fills before swapping it with db 0
+STAGING_DB = 4
+rd_staging = redis.StrictRedis(connection_pool = _pool(STAGING_DB, decode_responses = True))
+q = JobQueue("queue", connection_pool = _pool(2))
+# POST /jobs is refused while more than JOB_QUEUE_MAX_DEPTH jobs wait in the queue
+JOB_QUEUE_MAX_DEPTH = int(os.environ.get('JOB_QUEUE_MAX_DEPTH', '1000'))
+
+# job result images live apart from the job hashes, expire after JOB_RESULT_TTL seconds
+# and the oldest are dropped once they take more than JOB_RESULT_MAX_BYTES in total
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', str(24 * 60 * 60)))
+JOB_RESULT_MAX_BYTES = int(os.environ.get('JOB_RESULT_MAX_BYTES', str(256 * 1024 * 1024)))
+RESULTS_INDEX_KEY = 'job_results'
+RESULT_SIZES_KEY = 'job_results.sizes'
+RESULTS_BYTES_KEY = 'job_results.bytes'
+# Save a result image and count its size, replacing the size of an image the job had already.
+# KEYS: result, index, sizes, bytes  ARGV: jid, image, ttl, now
+_save_result_script = rd3.register_script("""
+local previous = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or 0)
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], string.len(ARGV[2]))
+return redis.call('INCRBY', KEYS[4], string.len(ARGV[2]) - previous)
+""")
+# Drop result images that were not saved again since they were picked, subtracting the size
+# of each one only if it was still counted, and return the size of the images left.
+# KEYS: index, sizes, bytes, then the result key of every job  ARGV: newest, then the job ids
+_drop_results_script = rd3.register_script("""
+local dropped = 0
+for i = 2, #ARGV do
+    local saved = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if not saved or tonumber(saved) <= tonumber(ARGV[1]) then
+        local size = redis.call('HGET', KEYS[2], ARGV[i])
+        redis.call('DEL', KEYS[i + 2])
+        redis.call('ZREM', KEYS[1], ARGV[i])
+        if size then
+            redis.call('HDEL', KEYS[2], ARGV[i])
+            dropped = dropped + tonumber(size)
+        end
+    end
+end
+return redis.call('DECRBY', KEYS[3], dropped)
+""")
+# statuses after which a job never changes again
+FINAL_STATUSES = ('complete', 'failed')
 
 def _generate_jid():
       """
@@ -24,6 +103,32 @@ def _generate_job_key(jid):
   """
   return 'job.{}'.format(jid)
 
+def _generate_result_key(jid):
+  """
+  Generate the redis key of the result image of a job.
+  """
+  return 'job_result.{}'.format(jid)
+
+def _generate_fingerprint_key(fingerprint):
+  """
+  Generate the redis key that maps a job fingerprint to the id of the job that has it.
+  """
+  return 'job_fingerprint.{}'.format(fingerprint)
+
+def job_status_channel(jid):
+  """
+  Generate the pub/sub channel on which the status changes of a job are published.
+  """
+  return 'job_status.{}'.format(jid)
+
+def job_fingerprint(start, end, data_version):
+      """
+      Return the canonical fingerprint of a job, built from its parameters and the version of
+      the data set it runs on. Identical analyses get the same fingerprint.
+      """
+      raw = json.dumps({'start': int(start), 'end': int(end), 'data_version': int(data_version)}, sort_keys=True)
+      return hashlib.sha1(raw.encode()).hexdigest()
+
 def _instantiate_job(jid, status, start, end):
       """
       Create the job object description as a python dictionary. Requires the job id, status,
@@ -45,12 +150,12 @@ def _save_job(job_key, job_dict):
       """Save a job object in the Redis database."""
       rd3.hset(job_key, mapping=job_dict)
 
-def _queue_job(jid):
-      """Add a job to the redis queue."""
-      q.put(jid)
+def _queue_job(jid, priority):
+      """Add a job to the redis queue in the lane of its priority."""
+      q.put(jid, priority)
 
 def get_job_by_id(job_key):
-    """Get the job from the redis database"""
+    """Get the job from the redis database, without its result image"""
     redis_return = rd3.hgetall(_generate_job_key(job_key))
     mydict = {}
     for keys in redis_return:
@@ -58,46 +163,145 @@ def get_job_by_id(job_key):
             mydict[keys.decode('utf-8')] = redis_return[keys].decode('utf-8')
     return mydict
 
-def add_job(start, end, status="submitted"):
-      """Add a job to the redis queue."""
+def _find_job(fingerprint):
+      """
+      Return the job with this fingerprint if it is queued, running or complete with its
+      image still stored, otherwise None.
+      """
+      jid = rd3.get(_generate_fingerprint_key(fingerprint))
+      if jid is None:
+          return None
+      job = get_job_by_id(jid.decode('utf-8'))
+      if not job or job['status'] == 'failed':
+          return None
+      if job['status'] == 'in progress' and not q.holds(job['id']):
+          # the worker running it died and the queue gave up on it
+          return None
+      if job['status'] == 'complete' and not rd3.exists(_generate_result_key(job['id'])):
+          return None
+      return job
+
+def _raise_priority(job, priority):
+      """
+      Move a job that is still queued up to the lane of `priority` if that lane is served
+      before its own, and return the job.
+      """
+      if PRIORITIES[priority] < PRIORITIES[job.get('priority', 'normal')] and q.promote(job['id'], priority):
+          rd3.hset(_generate_job_key(job['id']), 'priority', priority)
+          job['priority'] = priority
+      return job
+
+def count_new_jobs(specs, data_version):
+      """
+      Return how many jobs would be queued for `specs`, a list of (start, end) pairs, leaving
+      out repeats and jobs that add_job would find already queued, running or complete.
+      """
+      fingerprints = {job_fingerprint(start, end, data_version) for start, end in specs}
+      return sum(1 for fingerprint in fingerprints if _find_job(fingerprint) is None)
+
+def add_job(start, end, status="submitted", data_version=0, priority="normal"):
+      """
+      Add a job to the redis queue, unless an identical job on the same version of the data
+      set is already queued, running or complete, in which case that job is returned.
+      """
+      fingerprint = job_fingerprint(start, end, data_version)
+      existing = _find_job(fingerprint)
+      if existing is not None:
+          return _raise_priority(existing, priority)
       jid = _generate_jid()
-      job_dict = _instantiate_job(jid, status, start, end)
-      # update call to save_job:
+      # stored and returned as strings, the way get_job_by_id reads every job back
+      job_dict = _instantiate_job(jid, status, str(int(start)), str(int(end)))
+      job_dict['fingerprint'] = fingerprint
+      job_dict['submitted_at'] = '{:.3f}'.format(time.time())
+      job_dict['priority'] = priority
+      # the job is saved before it claims the fingerprint so whoever loses the claim
+      # always finds the winning job
       _save_job(_generate_job_key(jid), job_dict)
-      # update call to queue_job:
-      _queue_job(jid)
+      fingerprint_key = _generate_fingerprint_key(fingerprint)
+      if not rd3.set(fingerprint_key, jid, nx=True, ex=JOB_RESULT_TTL):
+          existing = _find_job(fingerprint)
+          if existing is not None:
+              rd3.delete(_generate_job_key(jid))
+              return _raise_priority(existing, priority)
+          rd3.set(fingerprint_key, jid, ex=JOB_RESULT_TTL)
+      _queue_job(jid, priority)
       return job_dict
 
+def _get_job_field(jid, field):
+    """Return one field of the specific job"""
+    value = rd3.hget(_generate_job_key(jid), field)
+    if value is None:
+        raise Exception()
+    return value.decode('utf-8')
+
+def get_job_status(jid):
+    """Return the status of the specific job, or None if there is no such job"""
+    status = rd3.hget(_generate_job_key(jid), 'status')
+    return status.decode('utf-8') if status is not None else None
+
 def update_job_status(jid, status):
-      """Update the status of job with job id `jid` to status `status`."""
-      job = get_job_by_id(jid)
-      if job:
-          job['status'] = status
-          _save_job(_generate_job_key(jid), job)
-      else:
+      """
+      Update the status of job with job id `jid` to status `status` and publish the change
+      to anyone waiting on the job.
+      """
+      if not rd3.exists(_generate_job_key(jid)):
           raise Exception()
+      pipe = rd3.pipeline()
+      pipe.hset(_generate_job_key(jid), 'status', status)
+      pipe.publish(job_status_channel(jid), status)
+      pipe.execute()
+
+def queue_is_full(new_jobs=1):
+      """Return True if queueing `new_jobs` more jobs would pass JOB_QUEUE_MAX_DEPTH."""
+      return len(q) + new_jobs > JOB_QUEUE_MAX_DEPTH
 
 def get_job_start(jid):
     """Return the start date of the specific job"""
-    job = get_job_by_id(jid)
-    if job:
-        return job['start']
-    else:
-        raise Exception()
+    return _get_job_field(jid, 'start')
 
 def get_job_end(jid):
     """Return the end date of the specific job"""
-    job = get_job_by_id(jid)
-    if job:
-        return job['end']
-    else:
-        raise Exception()
+    return _get_job_field(jid, 'end')
+
+def get_job_submitted_at(jid):
+    """Return the unix time the specific job was submitted, or None if it was not recorded"""
+    value = rd3.hget(_generate_job_key(jid), 'submitted_at')
+    return float(value) if value is not None else None
+
+def _drop_results(jids, newest):
+    """
+    Delete the result images of the given jobs that were saved at unix time `newest` or
+    before and stop counting their size. Returns the size of the images that are left.
+    """
+    keys = [_generate_result_key(jid.decode('utf-8')) for jid in jids]
+    return _drop_results_script(keys=[RESULTS_INDEX_KEY, RESULT_SIZES_KEY, RESULTS_BYTES_KEY] + keys,
+                                args=[newest] + list(jids))
+
+def _trim_results(keep, total):
+    """
+    Forget expired result images and drop the oldest ones while the `total` size of the
+    images is over the memory budget, never the image of job `keep` that was just saved.
+    """
+    cutoff = time.time() - JOB_RESULT_TTL
+    expired = rd3.zrangebyscore(RESULTS_INDEX_KEY, '-inf', cutoff)
+    if expired:
+        total = _drop_results(expired, cutoff)
+    while total > JOB_RESULT_MAX_BYTES:
+        oldest = [(jid, saved) for jid, saved in rd3.zrange(RESULTS_INDEX_KEY, 0, 9, withscores=True)
+                  if jid.decode('utf-8') != keep]
+        left = _drop_results([jid for jid, _ in oldest], oldest[-1][1]) if oldest else total
+        if left >= total:
+            break
+        total = left
 
 def update_job_image(jid, image):
-    """Update job with image"""
-    job = get_job_by_id(jid)
-    if job:
-        job['image'] = image
-        _save_job(_generate_job_key(jid), job)
-    else:
+    """Save the result image of a job"""
+    if not rd3.exists(_generate_job_key(jid)):
         raise Exception()
+    total = _save_result_script(keys=[_generate_result_key(jid), RESULTS_INDEX_KEY, RESULT_SIZES_KEY, RESULTS_BYTES_KEY],
+                                args=[jid, image, JOB_RESULT_TTL, time.time()])
+    _trim_results(jid, total)
+
+def get_job_image(jid):
+    """Return the result image of a job, or None if it has none or it has expired"""
+    return rd3.get(_generate_result_key(jid))
@@ -0,0 +1,153 @@
+import os
+import re
+import threading
+import time
+import redis
+
+# every process counts into memory and adds what it counted to one redis hash at most every
+# METRICS_FLUSH_INTERVAL seconds, so /metrics covers all API processes and workers while a
+# request costs no extra redis call
+METRICS_KEY = 'metrics'
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# name: (type, help) of every metric
+METRICS = {
+    'http_requests_total': ('counter', 'Requests served, by route, method and status.'),
+    'http_request_duration_seconds': ('histogram', 'Time to serve a request, including streaming the body.'),
+    'http_request_redis_calls_total': ('counter', 'Redis round trips made while serving requests, a pipeline is one.'),
+    'http_request_redis_seconds_total': ('counter', 'Time spent waiting on redis while serving requests.'),
+    'plot_cache_requests_total': ('counter', 'Plot cache lookups, by plot kind and hit or miss.'),
+    'plot_render_seconds': ('histogram', 'Time to select the data for a plot and draw it.'),
+    'cache_coalesced_total': ('counter', 'Plot and response cache misses that waited for another request computing the same entry.'),
+    'jobs_total': ('counter', 'Job attempts run by the workers, by status.'),
+    'job_wait_seconds': ('histogram', 'Time from submitting a job to a worker starting it.'),
+    'job_run_seconds': ('histogram', 'Time a worker takes to run a job.'),
+    'job_redis_calls_total': ('counter', 'Redis round trips made while running jobs.'),
+    'job_redis_seconds_total': ('counter', 'Time spent waiting on redis while running jobs.'),
+    'job_queue_depth': ('gauge', 'Jobs waiting in the queue.'),
+    'job_queue_claimed': ('gauge', 'Jobs taken off the queue by workers and not finished yet.'),
+    'jobs_rejected_total': ('counter', 'Job submissions refused because the queue was full.'),
+    'job_retries_total': ('counter', 'Job attempts that failed and were queued again.'),
+    'job_results_bytes': ('gauge', 'Bytes taken by stored job result images.'),
+}
+
+_pending = {}
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+_local = threading.local()
+
+class InstrumentedConnection(redis.Connection):
+    """Redis connection that adds up the round trips and time spent in redis per thread."""
+
+    def send_packed_command(self, command, check_health=True):
+        start = time.perf_counter()
+        try:
+            super().send_packed_command(command, check_health)
+        finally:
+            _local.calls = getattr(_local, 'calls', 0) + 1
+            _local.seconds = getattr(_local, 'seconds', 0.0) + time.perf_counter() - start
+
+    def read_response(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().read_response(*args, **kwargs)
+        finally:
+            _local.seconds = getattr(_local, 'seconds', 0.0) + time.perf_counter() - start
+
+def reset_redis_usage():
+    """Start counting the redis usage of the current thread from zero."""
+    _local.calls = 0
+    _local.seconds = 0.0
+
+def redis_usage():
+    """Return the redis round trips and seconds of the current thread since the last reset."""
+    return getattr(_local, 'calls', 0), getattr(_local, 'seconds', 0.0)
+
+def _escape(value):
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _sample(name, labels):
+    """Return the sample name of a metric with its labels, e.g. name{a="1",b="2"}."""
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items()))
+
+def inc(name, labels=None, value=1):
+    """Add `value` to a counter."""
+    sample = _sample(name, labels)
+    with _lock:
+        _pending[sample] = _pending.get(sample, 0) + value
+
+def observe(name, value, labels=None, buckets=LATENCY_BUCKETS):
+    """Record one observation of a histogram."""
+    labels = labels or {}
+    # every bucket is written, with 0 where the value is above its bound, so none is missing
+    increments = [(_sample(name + '_bucket', dict(labels, le='{:g}'.format(bound))), int(value <= bound))
+                  for bound in buckets]
+    increments.append((_sample(name + '_bucket', dict(labels, le='+Inf')), 1))
+    increments.append((_sample(name + '_count', labels), 1))
+    increments.append((_sample(name + '_sum', labels), value))
+    with _lock:
+        for sample, increment in increments:
+            _pending[sample] = _pending.get(sample, 0) + increment
+
+def flush(client):
+    """Add everything counted in this process since the last flush to the shared totals."""
+    global _pending, _last_flush
+    with _lock:
+        pending, _pending = _pending, {}
+        _last_flush = time.monotonic()
+    if not pending:
+        return
+    try:
+        pipe = client.pipeline(transaction=False)
+        for sample, value in pending.items():
+            pipe.hincrbyfloat(METRICS_KEY, sample, value)
+        pipe.execute()
+    except redis.RedisError:
+        # keep the counts for the next flush rather than lose them
+        with _lock:
+            for sample, value in pending.items():
+                _pending[sample] = _pending.get(sample, 0) + value
+
+def maybe_flush(client):
+    """Flush if the last flush was more than METRICS_FLUSH_INTERVAL seconds ago."""
+    if time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL:
+        flush(client)
+
+def _sort_key(sample):
+    """Order samples by metric, then labels, then histogram bucket bound."""
+    le = re.search(r'le="([^"]*)"', sample)
+    if le is None:
+        return sample, 0.0
+    return sample[:le.start()] + sample[le.end():], float(le.group(1).replace('+Inf', 'inf'))
+
+def _family(sample):
+    """Return the metric a sample belongs to."""
+    name = sample.split('{', 1)[0]
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and METRICS.get(name[:-len(suffix)], ('',))[0] == 'histogram':
+            return name[:-len(suffix)]
+    return name
+
+def render(client, gauges=None):
+    """
+    Return the shared totals, plus the given current `gauges` values, in the Prometheus text
+    exposition format.
+    """
+    flush(client)
+    samples = {sample.decode('utf-8'): value.decode('utf-8') for sample, value in client.hgetall(METRICS_KEY).items()}
+    samples.update({name: str(value) for name, value in (gauges or {}).items()})
+    families = {}
+    for sample in samples:
+        families.setdefault(_family(sample), []).append(sample)
+    lines = []
+    for family in sorted(families):
+        kind, description = METRICS.get(family, ('untyped', ''))
+        lines.append('# HELP {} {}'.format(family, description))
+        lines.append('# TYPE {} {}'.format(family, kind))
+        for sample in sorted(families[family], key=_sort_key):
+            lines.append('{} {}'.format(sample, samples[sample]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,315 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import redis
+from jobs import rd2
+import datastore
+import metrics
+
+PLOT_CACHE_BYTES = int(os.environ.get('PLOT_CACHE_BYTES', str(64 * 1024 * 1024)))
+PLOT_CACHE_TTL = int(os.environ.get('PLOT_CACHE_TTL', '3600'))
+# a miss is computed by one request at a time across every replica: the others wait for it
+# under a redis lock held at most SINGLE_FLIGHT_LOCK_TTL seconds, woken by a notification
+# or else checking again every SINGLE_FLIGHT_POLL seconds
+SINGLE_FLIGHT_LOCK_TTL = int(os.environ.get('SINGLE_FLIGHT_LOCK_TTL', '60'))
+SINGLE_FLIGHT_POLL = float(os.environ.get('SINGLE_FLIGHT_POLL', '1'))
+COMPUTED_CHANNEL_PREFIX = 'computed:'
+# the copies in redis are dropped oldest first once a cache takes more than its redis budget,
+# and entries over CACHE_ENTRY_MAX_BYTES are only kept in process
+PLOT_CACHE_REDIS_BYTES = int(os.environ.get('PLOT_CACHE_REDIS_BYTES', str(256 * 1024 * 1024)))
+CACHE_ENTRY_MAX_BYTES = int(os.environ.get('CACHE_ENTRY_MAX_BYTES', str(8 * 1024 * 1024)))
+# Save an entry and count its size, replacing the size of the entry it overwrites.
+# KEYS: entry, index, sizes, bytes  ARGV: data, ttl, now
+_save_entry_script = rd2.register_script("""
+local previous = tonumber(redis.call('HGET', KEYS[3], KEYS[1]) or 0)
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('HSET', KEYS[3], KEYS[1], string.len(ARGV[1]))
+return redis.call('INCRBY', KEYS[4], string.len(ARGV[1]) - previous)
+""")
+# Drop entries that were not saved again since they were picked, subtracting the size of each
+# one only if it was still counted, and return the size of the entries left.
+# KEYS: index, sizes, bytes, then the entries  ARGV: newest
+_drop_entries_script = rd2.register_script("""
+local dropped = 0
+for i = 4, #KEYS do
+    local saved = redis.call('ZSCORE', KEYS[1], KEYS[i])
+    if not saved or tonumber(saved) <= tonumber(ARGV[1]) then
+        local size = redis.call('HGET', KEYS[2], KEYS[i])
+        redis.call('DEL', KEYS[i])
+        redis.call('ZREM', KEYS[1], KEYS[i])
+        if size then
+            redis.call('HDEL', KEYS[2], KEYS[i])
+            dropped = dropped + tonumber(size)
+        end
+    end
+end
+return redis.call('DECRBY', KEYS[3], dropped)
+""")
+
+def cache_key(kind, params, data_version):
+    """
+    Generate the redis key of a plot from the plot kind, its parameters and the data set
+    version it was drawn from.
+    """
+    raw = json.dumps([kind, params, data_version], sort_keys=True)
+    return 'plot:{}:{}'.format(kind, hashlib.sha1(raw.encode()).hexdigest())
+
+class CacheWatcher:
+    """
+    Wakes the threads of this process that wait for a request of another replica to compute
+    a cache entry. The process holds a single pattern subscription to every computed channel,
+    read by one background thread, so waiting on a miss costs no extra connection.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # key -> number of threads waiting on it, and how many times it was computed since
+        self._waiters = {}
+        self._computed = {}
+        self._thread = None
+        self._subscribed = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        """Start the listener thread in this process, if it is not running yet."""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._subscribed.clear()
+                self._thread = threading.Thread(target=self._listen, name='cache-watcher', daemon=True)
+                self._thread.start()
+        self._subscribed.wait(timeout=5)
+
+    def _listen(self):
+        """Read notifications forever, reconnecting after redis errors."""
+        while True:
+            pubsub = rd2.pubsub()
+            try:
+                pubsub.psubscribe(COMPUTED_CHANNEL_PREFIX + '*')
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    if message['type'] == 'psubscribe':
+                        self._subscribed.set()
+                    elif message['type'] == 'pmessage':
+                        self._notify(message['channel'].decode('utf-8')[len(COMPUTED_CHANNEL_PREFIX):])
+            except redis.RedisError:
+                # waiters fall back to checking the cache every SINGLE_FLIGHT_POLL seconds
+                self._subscribed.clear()
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+    def _notify(self, key):
+        """Count a computed entry and wake the waiting threads."""
+        with self._cond:
+            if key in self._waiters:
+                self._computed[key] += 1
+                self._cond.notify_all()
+
+    def watch(self, key):
+        """Start counting the notifications for `key`, returning the count so far."""
+        self._start()
+        with self._cond:
+            self._waiters[key] = self._waiters.get(key, 0) + 1
+            return self._computed.setdefault(key, 0)
+
+    def wait(self, key, seen, timeout):
+        """Wait at most `timeout` seconds for the count of `key` to pass `seen` and return it."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._computed[key] != seen, timeout)
+            return self._computed[key]
+
+    def unwatch(self, key):
+        """Stop counting the notifications for `key` once no thread waits on it."""
+        with self._cond:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._computed[key]
+
+_watcher = CacheWatcher()
+
+class ByteCache:
+    """
+    Two level cache of rendered bytes, such as plots. Entries are shared between API replicas
+    through redis db 1 with a TTL, within a byte budget tracked under the cache `name`, and
+    the most recently used ones are also kept in process, within a smaller budget, so repeat
+    requests do not touch redis at all.
+    """
+
+    def __init__(self, name, max_bytes=PLOT_CACHE_BYTES, ttl=PLOT_CACHE_TTL,
+                 redis_max_bytes=PLOT_CACHE_REDIS_BYTES, entry_max_bytes=CACHE_ENTRY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.redis_max_bytes = redis_max_bytes
+        self.entry_max_bytes = entry_max_bytes
+        self._index = '{}_cache'.format(name)
+        self._sizes = '{}_cache.sizes'.format(name)
+        self._bytes = '{}_cache.bytes'.format(name)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # key -> event set when the thread of this process computing it is done
+        self._flights = {}
+
+    def _remember(self, key, data):
+        """Keep an entry in process, evicting the least recently used ones over the budget."""
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = (time.monotonic() + self.ttl, data)
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _forget(self, key):
+        """Drop an entry from the process, the caller holds the lock."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def get(self, key):
+        """Return the cached bytes, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                self._forget(key)
+        data = rd2.get(key)
+        if data is not None:
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        """Cache the bytes, in process only if they are too large to share through redis."""
+        if len(data) <= min(self.entry_max_bytes, self.redis_max_bytes):
+            total = _save_entry_script(keys=[key, self._index, self._sizes, self._bytes],
+                                       args=[data, self.ttl, time.time()])
+            self._trim(key, total)
+        self._remember(key, data)
+
+    def _drop(self, keys, newest):
+        """
+        Delete the given entries from redis if they were saved at unix time `newest` or before
+        and stop counting their size. Returns the size of the entries that are left.
+        """
+        return _drop_entries_script(keys=[self._index, self._sizes, self._bytes] + list(keys), args=[newest])
+
+    def _trim(self, keep, total):
+        """
+        Forget expired entries and drop the oldest ones from redis while the `total` size of
+        the entries is over the redis budget, never the entry `keep` that was just saved.
+        """
+        cutoff = time.time() - self.ttl
+        expired = rd2.zrangebyscore(self._index, '-inf', cutoff)
+        if expired:
+            total = self._drop(expired, cutoff)
+        while total > self.redis_max_bytes:
+            oldest = [(key, saved) for key, saved in rd2.zrange(self._index, 0, 9, withscores=True)
+                      if key.decode('utf-8') != keep]
+            left = self._drop([key for key, _ in oldest], oldest[-1][1]) if oldest else total
+            if left >= total:
+                break
+            total = left
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached bytes, calling `compute()` and caching its result on a miss. Only
+        one thread per process waits on redis for a key, and only one request across every
+        replica computes it, while the others wait and read the result from the cache.
+        """
+        while True:
+            data = self.get(key)
+            if data is not None:
+                return data
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = threading.Event()
+            if leader:
+                try:
+                    return self._compute_once(key, compute)
+                finally:
+                    with self._lock:
+                        del self._flights[key]
+                    flight.set()
+            metrics.inc('cache_coalesced_total')
+            # if that thread failed the next pass computes it here
+            flight.wait()
+
+    def _compute_once(self, key, compute):
+        """Compute and cache a missing entry, unless a request of another process does."""
+        lock = rd2.lock('lock:' + key, timeout=SINGLE_FLIGHT_LOCK_TTL)
+        watching = False
+        seen = 0
+        try:
+            while True:
+                data = self.get(key)
+                if data is not None:
+                    if watching:
+                        metrics.inc('cache_coalesced_total')
+                    return data
+                if lock.acquire(blocking=False):
+                    try:
+                        data = compute()
+                        self.put(key, data)
+                        return data
+                    finally:
+                        try:
+                            lock.release()
+                        except redis.exceptions.LockError:
+                            # computing took longer than the lock lasts
+                            pass
+                        rd2.publish(COMPUTED_CHANNEL_PREFIX + key, '1')
+                if watching:
+                    seen = _watcher.wait(key, seen, SINGLE_FLIGHT_POLL)
+                else:
+                    # watched before looking again, so the notification cannot be missed
+                    seen = _watcher.watch(key)
+                    watching = True
+        finally:
+            if watching:
+                _watcher.unwatch(key)
+
+    def delete(self, key):
+        """Remove an entry from the cache, returning True if it was cached."""
+        with self._lock:
+            cached = key in self._entries
+            self._forget(key)
+        stored = rd2.exists(key)
+        self._drop([key], time.time())
+        return bool(stored) or cached
+
+_cache = ByteCache('plot')
+
+def get_or_render(kind, params, render):
+    """
+    Return the plot of `kind` with `params` for the current data set version, calling
+    `render()` to draw and cache it on a miss. Concurrent misses for the same plot draw it
+    once.
+    """
+    key = cache_key(kind, params, datastore.version())
+    rendered = []
+    def timed_render():
+        start = time.perf_counter()
+        data = render()
+        metrics.observe('plot_render_seconds', time.perf_counter() - start, {'kind': kind})
+        rendered.append(True)
+        return data
+    data = _cache.get_or_compute(key, timed_render)
+    metrics.inc('plot_cache_requests_total', {'kind': kind, 'result': 'miss' if rendered else 'hit'})
+    return data
+
+def delete(kind, params):
+    """Remove the plot of `kind` with `params` for the current data set version from the cache."""
+    return _cache.delete(cache_key(kind, params, datastore.version()))
@@ -0,0 +1,60 @@
+import io
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+def _new_axes():
+    """
+    Create a figure with its own Agg canvas and return it with its axes. Nothing here
+    touches the global pyplot state, so plots can be drawn from many threads at once.
+    """
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot()
+
+def _png_bytes(fig):
+    """Render a figure to PNG bytes in memory."""
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+def co2_year_plot(years, co2):
+    """Draw the average CO2 emissions of all vehicles against the model year."""
+    fig, ax = _new_axes()
+    ax.scatter(years, co2)
+    ax.set_title('Average Vehicle CO2 Emissions from 1975-2021')
+    ax.set_ylabel('Real-World CO2 (g/mi)')
+    ax.set_xlabel('Year')
+    return _png_bytes(fig)
+
+def weight_mpg_plot(year, weights, mpgs):
+    """Draw the weight against the fuel economy of the vehicles from one model year."""
+    fig, ax = _new_axes()
+    ax.scatter(weights, mpgs)
+    ax.set_title('Vehicle Weight vs Fuel Economy in ' + year)
+    ax.set_xlabel('Weight (lbs)')
+    ax.set_ylabel('Miles per Gallon')
+    return _png_bytes(fig)
+
+def vehicle_type_mpg_plot(year, vehicle_types, mpgs):
+    """Draw the fuel economy of each vehicle type from one model year."""
+    fig, ax = _new_axes()
+    ax.bar(vehicle_types, mpgs, color = 'g', width = 0.72, label = "MPG")
+    ax.set_xlabel('Vehicle Type')
+    ax.set_ylabel('MPG')
+    ax.set_title(year + ': MPG vs Vehicle Type')
+    ax.legend()
+    return _png_bytes(fig)
+
+def co2_vehicle_type_plot(start, end, series):
+    """
+    Draw the CO2 emissions of each vehicle type over a range of model years. `series` maps
+    each vehicle type to its (years, co2) arrays.
+    """
+    fig, ax = _new_axes()
+    for vehicle_type, (years, co2) in series.items():
+        ax.scatter(years, co2, label = vehicle_type)
+    ax.set_title('CO2 Emissions by Vehicle Type from '+str(start)+'-'+str(end))
+    ax.set_ylabel('Real-World CO2 (g/mi)')
+    ax.set_xlabel('Year')
+    ax.legend()
+    return _png_bytes(fig)
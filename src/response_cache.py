@@ -0,0 +1,68 @@
+import gzip
+import hashlib
+import json
+import os
+from plot_cache import ByteCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+RESPONSE_CACHE_BYTES = int(os.environ.get('RESPONSE_CACHE_BYTES', str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_REDIS_BYTES = int(os.environ.get('RESPONSE_CACHE_REDIS_BYTES', str(256 * 1024 * 1024)))
+# smaller bodies are sent as they are, compressing them saves next to nothing
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+_cache = ByteCache('response', RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_REDIS_BYTES)
+
+class VersionChanged(Exception):
+    """Raised by a build when the data set changed under it, so its body is not cached."""
+
+def encodings():
+    """Return the content encodings responses can be compressed with, best first."""
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def _compress(body, encoding):
+    """Compress a body with the given content encoding."""
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+def cache_key(path, data_version, encoding):
+    """
+    Generate the redis key of a response body from the request path with its normalized
+    query, the data set version it was built from and its content encoding.
+    """
+    raw = json.dumps([path, data_version, encoding])
+    return 'response:{}'.format(hashlib.sha1(raw.encode()).hexdigest())
+
+def get_or_build(path, data_version, encoding, build):
+    """
+    Return the body of the response to `path` for a data set version and the content
+    encoding it is in, calling `build()` for the uncompressed body on a miss. A body is
+    compressed with `encoding` at most once per version, unless it is too small to be
+    worth it, in which case it is returned uncompressed.
+    """
+    def build_entry():
+        # entries are the encoding actually used, a newline and the body
+        if encoding == 'identity':
+            return b'identity\n' + build()
+        # the uncompressed body is reused when it is cached, but never waited for, so one
+        # miss is never held up by the flight of another
+        identity_key = cache_key(path, data_version, 'identity')
+        entry = _cache.get(identity_key)
+        if entry is None:
+            entry = b'identity\n' + build()
+            _cache.put(identity_key, entry)
+        body = entry.split(b'\n', 1)[1]
+        if len(body) < COMPRESS_MIN_BYTES:
+            return entry
+        return encoding.encode() + b'\n' + _compress(body, encoding)
+    # concurrent misses for the same body build it once
+    entry = _cache.get_or_compute(cache_key(path, data_version, encoding), build_entry)
+    used, body = entry.split(b'\n', 1)
+    return body, used.decode()
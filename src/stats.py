@@ -0,0 +1,103 @@
+import numpy as np
+
+GROUP_FIELDS = {'year': 'Model Year', 'manufacturer': 'Manufacturer', 'vehicle_type': 'Vehicle Type'}
+DEFAULT_COLUMNS = ['Real-World MPG', 'Real-World CO2 (g/mi)', 'Weight (lbs)', 'Horsepower (HP)', 'Production Share']
+AGGREGATES = ['count', 'mean', 'min', 'max', 'weighted_mean', 'harmonic_mean']
+WEIGHT_COLUMN = 'Production Share'
+
+def _group_codes(data, rows, group_by):
+    """
+    Number the distinct combinations of the `group_by` fields among the selected rows.
+    Returns the group number of every selected row and the field values of every group.
+    """
+    if not group_by:
+        return np.zeros(int(rows.sum()), dtype=np.intp), [{}]
+    labels = []
+    codes = []
+    for field in group_by:
+        values, inverse = data.factorize(GROUP_FIELDS[field], rows)
+        labels.append(values)
+        codes.append(inverse.ravel())
+    combined = np.ravel_multi_index(codes, [len(values) for values in labels])
+    keys, groups = np.unique(combined, return_inverse=True)
+    groups_fields = []
+    for key in keys:
+        index = np.unravel_index(key, [len(values) for values in labels])
+        groups_fields.append({field: str(labels[i][index[i]]) for i, field in enumerate(group_by)})
+    return groups.ravel(), groups_fields
+
+def _reduce(groups, n, x, weights, aggregates):
+    """Compute the requested aggregates of `x` for every group with NumPy reductions."""
+    valid = ~np.isnan(x)
+    g = groups[valid]
+    count = np.bincount(g, minlength=n).astype(float)
+    result = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if 'count' in aggregates:
+            result['count'] = count
+        if 'mean' in aggregates:
+            result['mean'] = np.bincount(g, weights=x[valid], minlength=n) / count
+        if 'min' in aggregates:
+            low = np.full(n, np.inf)
+            np.minimum.at(low, g, x[valid])
+            result['min'] = np.where(np.isinf(low), np.nan, low)
+        if 'max' in aggregates:
+            high = np.full(n, -np.inf)
+            np.maximum.at(high, g, x[valid])
+            result['max'] = np.where(np.isinf(high), np.nan, high)
+        if 'weighted_mean' in aggregates or 'harmonic_mean' in aggregates:
+            weighted = valid & ~np.isnan(weights)
+            gw = groups[weighted]
+            w = weights[weighted]
+            xw = x[weighted]
+            if 'weighted_mean' in aggregates:
+                result['weighted_mean'] = (np.bincount(gw, weights=w * xw, minlength=n) /
+                                           np.bincount(gw, weights=w, minlength=n))
+            if 'harmonic_mean' in aggregates:
+                nonzero = xw != 0
+                gh = gw[nonzero]
+                result['harmonic_mean'] = (np.bincount(gh, weights=w[nonzero], minlength=n) /
+                                           np.bincount(gh, weights=w[nonzero] / xw[nonzero], minlength=n))
+    return result
+
+def _to_json(agg, value):
+    """Convert one aggregate value to a JSON friendly number, None if it is missing."""
+    if np.isnan(value):
+        return None
+    return int(value) if agg == 'count' else float(value)
+
+def aggregate(data, rows, group_by=(), columns=None, aggregates=None):
+    """
+    Group the selected rows of the data set by the `group_by` fields ('year', 'manufacturer'
+    and/or 'vehicle_type') and aggregate each numeric column. The weighted and harmonic
+    means are weighted by production share, like the averages the EPA publishes.
+
+    Returns a list with one dictionary per group holding its field values and, for every
+    column, a dictionary of aggregate values (None where a group has no values). Raises
+    ValueError for an unknown group field, column or aggregate.
+    """
+    columns = columns or [name for name in DEFAULT_COLUMNS if name in data.numeric]
+    aggregates = aggregates or AGGREGATES
+    for field in group_by:
+        if field not in GROUP_FIELDS:
+            raise ValueError('cannot group by {}, choose from {}'.format(field, ', '.join(GROUP_FIELDS)))
+    for name in columns:
+        if name not in data.numeric:
+            raise ValueError('{} is not a numeric column'.format(name))
+    for name in aggregates:
+        if name not in AGGREGATES:
+            raise ValueError('unknown aggregate {}, choose from {}'.format(name, ', '.join(AGGREGATES)))
+    if not rows.any():
+        return []
+    groups, groups_fields = _group_codes(data, rows, group_by)
+    n = len(groups_fields)
+    if WEIGHT_COLUMN in data.numeric:
+        weights = data.values(WEIGHT_COLUMN)[rows]
+    else:
+        weights = np.full(int(rows.sum()), np.nan)
+    output = [dict(fields) for fields in groups_fields]
+    for name in columns:
+        reduced = _reduce(groups, n, data.values(name)[rows], weights, aggregates)
+        for i, group in enumerate(output):
+            group[name] = {agg: _to_json(agg, values[i]) for agg, values in reduced.items()}
+    return output
@@ -1,48 +1,207 @@
+import functools
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import jobs
+import metrics
+import dataset
+import plots
 import redis
-import matplotlib.pyplot as plt
-import numpy as np
 
-@jobs.q.worker
-def execute_job(jid):
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '1'))
+WORKER_PREFETCH = int(os.environ.get('WORKER_PREFETCH', '1'))
+# a job is tried at most JOB_MAX_ATTEMPTS times, counting the deliveries lost with a worker
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+# how often the visibility timeout of the jobs a worker holds is pushed back
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', '15'))
+
+log = logging.getLogger('worker')
+
+def execute_job(jid, final=True):
+    """
+      Run one job and record how long it waited in the queue and took to run. A job that
+      raises is marked failed if this is its `final` attempt, otherwise it will be retried.
+    """
+    started = time.time()
+    submitted_at = jobs.get_job_submitted_at(jid)
+    if submitted_at is not None:
+        metrics.observe('job_wait_seconds', max(0.0, started - submitted_at))
+    metrics.reset_redis_usage()
+    status = 'failed' if final else 'retry'
+    try:
+        _run_job(jid)
+        status = jobs.get_job_status(jid)
+    except Exception:
+        if final:
+            jobs.update_job_status(jid, 'failed')
+        raise
+    finally:
+        calls, seconds = metrics.redis_usage()
+        metrics.inc('jobs_total', {'status': status})
+        metrics.observe('job_run_seconds', time.time() - started)
+        metrics.inc('job_redis_calls_total', value=calls)
+        metrics.inc('job_redis_seconds_total', value=seconds)
+        metrics.flush(jobs.rd3)
+
+def _run_job(jid):
     """
-      Retrieve a job id from the task queue and execute the job.
       Monitors the job to completion and updates the database accordingly.
     """
     jobs.update_job_status(jid, 'in progress')
     # start the analysis
-    if len(jobs.rd.keys()) == 0:
-        return 'Auto Trends data not loaded in Redis yet\n'
+    data = dataset.get_dataset()
+    if not len(data):
+        # nothing to analyse until the data set is loaded again
+        jobs.update_job_status(jid, 'failed')
+        return
     else:
-        years = {}
-        co2 = {}
-        cars_list = []
         start = int(jobs.get_job_start(jid))
         end = int(jobs.get_job_end(jid))
-        for key in jobs.rd.keys():
-            if jobs.rd.hget(key, 'Manufacturer') == 'All':
-                cars_list.append(jobs.rd.hgetall(key))
-        for car in cars_list:
-            if car['Vehicle Type'] not in co2:
-                co2[car['Vehicle Type']] = []
-            if car['Vehicle Type'] not in years:
-                years[car['Vehicle Type']] = []
-            if car['Model Year'].isdigit() and start <= int(car['Model Year']) <= end:
-                years[car['Vehicle Type']].append(int(car['Model Year']))
-                co2[car['Vehicle Type']].append(float(car['Real-World CO2 (g/mi)']))
-        for key in co2:
-            plt.scatter(np.array(years[key]), np.array(co2[key]), label = key)
-        plt.title('CO2 Emissions by Vehicle Type from '+str(start)+'-'+str(end))
-        plt.ylabel('Real-World CO2 (g/mi)')
-        plt.xlabel('Year')
-        plt.legend()
-        plt.savefig('./output_img2.png')
-        plt.clf()
-        file_bytes = open('./output_img2.png', 'rb').read()
-        # set the file bytes as a key in Redis
-        jobs.rd2.set('plotimage2', file_bytes)
+        manufacturer = data.mask(manufacturer='All')
+        in_range = manufacturer & data.mask(start=start, end=end)
+        co2 = data.values('Real-World CO2 (g/mi)')
+        series = {}
+        for key in dict.fromkeys(data.strings('Vehicle Type', manufacturer)):
+            rows = in_range & data.mask(vehicle_type=key)
+            series[key] = (data.year[rows], co2[rows])
+        render_start = time.perf_counter()
+        file_bytes = plots.co2_vehicle_type_plot(start, end, series)
+        metrics.observe('plot_render_seconds', time.perf_counter() - render_start, {'kind': 'co2_vehicle_type_plot'})
         jobs.update_job_image(jid, file_bytes)
     jobs.update_job_status(jid, 'complete')
 
+def _finish(jid, attempts, future):
+    """
+      Acknowledge a job once it ran, or queue it again if it raised and has attempts left.
+      A job that raised on its last attempt is marked failed if it is not already.
+    """
+    error = future.exception()
+    if error is not None:
+        log.error('job %s failed on attempt %d of %d', jid, attempts, JOB_MAX_ATTEMPTS, exc_info=error)
+    if error is None or attempts >= JOB_MAX_ATTEMPTS:
+        if error is not None and jobs.get_job_status(jid) not in jobs.FINAL_STATUSES + (None,):
+            # the process running it died, so nothing marked the job failed
+            jobs.update_job_status(jid, 'failed')
+        if not jobs.q.ack(jid, attempts):
+            log.warning('job %s was delivered again before it was acknowledged', jid)
+        return
+    metrics.inc('job_retries_total')
+    try:
+        jobs.update_job_status(jid, 'submitted')
+    except Exception:
+        # the job was deleted meanwhile
+        jobs.q.ack(jid, attempts)
+        return
+    if not jobs.q.retry(jid, attempts):
+        log.warning('job %s was delivered again before it was retried', jid)
+
+def _init_pool_process():
+    """
+      Set the signal handling of a pool process: SIGTERM ends it, and a Ctrl-C sent to the
+      whole process group leaves the running job to finish while the worker stops.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run(concurrency=WORKER_CONCURRENCY, prefetch=WORKER_PREFETCH):
+    """
+      Claim jobs from the task queue and run them on a pool of `concurrency` processes.
+      At most `prefetch` jobs are claimed ahead of a free process, so the rest stay queued
+      for other worker replicas. Claimed jobs are kept hidden from other workers by
+      heartbeats and are delivered again if this worker dies. On SIGTERM or SIGINT the
+      worker stops taking jobs, finishes the ones it already took and exits.
+    """
+    stopping = threading.Event()
+    def stop(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    slots = threading.BoundedSemaphore(concurrency + prefetch)
+    # job id -> attempt, for every job claimed and not finished yet
+    claimed = {}
+    claimed_lock = threading.Lock()
+    finished = threading.Event()
+    def heartbeat():
+        while not finished.wait(JOB_HEARTBEAT_INTERVAL):
+            with claimed_lock:
+                claims = dict(claimed)
+            try:
+                jobs.q.heartbeat(claims)
+            except redis.RedisError:
+                # the jobs are delivered again if this keeps failing past the timeout
+                pass
+    threading.Thread(target=heartbeat, name='heartbeat', daemon=True).start()
+    def done(jid, attempts, future):
+        # forgotten before it can be queued and claimed again
+        with claimed_lock:
+            del claimed[jid]
+        try:
+            _finish(jid, attempts, future)
+            metrics.maybe_flush(jobs.rd3)
+        except Exception:
+            # an unacknowledged job is delivered again once its visibility timeout passes
+            log.exception('could not finish job %s', jid)
+        finally:
+            slots.release()
+    def new_pool():
+        # pool processes are started from a clean server process rather than forked from this
+        # one, which runs threads that may hold a lock at the moment of the fork
+        return ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context('forkserver'),
+                                   initializer=_init_pool_process)
+    pool = new_pool()
+    try:
+        while not stopping.is_set():
+            if not slots.acquire(timeout=1):
+                continue
+            try:
+                found = jobs.q.claim(timeout=1)
+            except redis.RedisError:
+                log.exception('could not claim a job, trying again')
+                slots.release()
+                time.sleep(1)
+                continue
+            if found is None:
+                slots.release()
+                continue
+            jid, attempts = found
+            if attempts > JOB_MAX_ATTEMPTS:
+                # every attempt was lost with the worker running it
+                try:
+                    try:
+                        jobs.update_job_status(jid, 'failed')
+                    finally:
+                        jobs.q.ack(jid, attempts)
+                except Exception:
+                    log.exception('could not mark job %s failed after %d attempts', jid, attempts - 1)
+                slots.release()
+                continue
+            with claimed_lock:
+                claimed[jid] = attempts
+            try:
+                future = pool.submit(execute_job, jid, attempts >= JOB_MAX_ATTEMPTS)
+            except BrokenProcessPool:
+                # a pool process died, the jobs it held fail and are retried by their callbacks
+                log.exception('the process pool is broken, starting a new one')
+                with claimed_lock:
+                    del claimed[jid]
+                try:
+                    jobs.q.retry(jid, attempts)
+                except redis.RedisError:
+                    log.exception('could not queue job %s again', jid)
+                slots.release()
+                pool.shutdown(wait=False)
+                pool = new_pool()
+                continue
+            future.add_done_callback(functools.partial(done, jid, attempts))
+    finally:
+        pool.shutdown(wait=True)
+        finished.set()
+
 if __name__ == '__main__':
-    execute_job()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    run()